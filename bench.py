@@ -0,0 +1,528 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Воспроизводимый замер стриминга pyrrent2http без сети.
+
+Создаёт во временном каталоге синтетический торрент, раздаёт его несколькими
+сессиями libtorrent на адресах 127.0.0.x (DHT, LSD, UPnP и NAT-PMP выключены,
+пиров раздаёт встроенный HTTP-трекер), запускает pyrrent2http.py и гоняет
+/files/ сценариями плеера:
+
+    linear      воспроизведение с начала с заданным битрейтом
+    probe       чтение заголовка и хвоста (индекса), затем воспроизведение
+    seeks       воспроизведение и случайные перемотки по одному соединению
+    concurrent  несколько клиентов одновременно
+
+Каждый сценарий получает свежий процесс pyrrent2http и пустой каталог загрузки.
+Отчёт: время до первого байта, задержка перемотки, число и длительность
+остановок воспроизведения, пропускная способность HTTP, процессорное время
+pyrrent2http на отданный гигабайт и сводка из /metrics.
+
+С --server замер идёт против уже запущенного pyrrent2http, без своего роя.
+'''
+import argparse
+import sys, os
+import logging
+import json
+import time
+import random
+import shlex
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import subprocess
+import resource
+import urlparse, urllib
+import httplib
+import BaseHTTPServer
+
+logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+
+SCENARIOS = ('linear', 'probe', 'seeks', 'concurrent')
+CHUNK = 64 * 1024
+SERVER_START_TIMEOUT = 30.0
+SEED_START_TIMEOUT = 60.0
+
+#######################################################################################
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(round(q * (len(values) - 1))), len(values) - 1)]
+
+def summary(values):
+    '''Среднее, медиана, 95-й процентиль и максимум'''
+    if not values:
+        return None
+    return {'mean': sum(values) / len(values), 'p50': percentile(values, 0.5),
+            'p95': percentile(values, 0.95), 'max': max(values), 'count': len(values)}
+
+def fetchMetrics(url):
+    '''Сумма значений каждой метрики Prometheus из /metrics по всем меткам'''
+    try:
+        text = urllib.urlopen(url + '/metrics').read()
+    except IOError:
+        return dict()
+    totals = dict()
+    for line in text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        name, _, value = line.rpartition(' ')
+        name = name.split('{', 1)[0]
+        try:
+            totals[name] = totals.get(name, 0.0) + float(value)
+        except ValueError:
+            pass
+    return totals
+
+#######################################################################################
+
+class Tracker(object):
+    '''HTTP-трекер на loopback: качающим отдаёт адреса сидов, сидам - пустой список'''
+    def __init__(self, seeds):
+        self.seeds = seeds      # [(адрес, порт)]
+        tracker = self
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                query = urlparse.parse_qs(urlparse.urlsplit(self.path).query)
+                peers = ''
+                if query.get('left', ['1'])[0] != '0':
+                    peers = ''.join(socket.inet_aton(host) + struct.pack('>H', port) for host, port in tracker.seeds)
+                body = tracker.bencode({'interval': 30, 'min interval': 5, 'peers': peers})
+                self.send_response(200)
+                self.send_header('Content-type', 'text/plain')
+                self.send_header('Content-Length', len(body))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, format, *args):
+                pass
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d/announce' % (self.server.server_address[1],)
+        self.thread = threading.Thread(target = self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+    def bencode(self, value):
+        if isinstance(value, dict):
+            return 'd' + ''.join(self.bencode(k) + self.bencode(value[k]) for k in sorted(value)) + 'e'
+        if isinstance(value, (int, long)):
+            return 'i%de' % (value,)
+        return '%d:%s' % (len(value), value)
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class Swarm(object):
+    '''Синтетический торрент и его сиды: отдельные сессии libtorrent на 127.0.0.2, 127.0.0.3...
+    Разные адреса нужны, потому что libtorrent по умолчанию не открывает
+    несколько соединений с одним IP'''
+    def __init__(self, config, workDir):
+        import libtorrent as lt
+        self.lt = lt
+        self.config = config
+        self.dataDir = os.path.join(workDir, 'seed')
+        self.torrentPath = os.path.join(workDir, 'bench.torrent')
+        self.files = list()
+        self.sessions = list()
+        seeds = [('127.0.0.%d' % (2 + i,), config.seedPort + i) for i in range(config.seeders)]
+        self.tracker = Tracker(seeds)
+        self.makeTorrent()
+        for host, port in seeds:
+            self.startSeed(host, port)
+    def makeTorrent(self):
+        lt = self.lt
+        root = os.path.join(self.dataDir, 'bench')
+        os.makedirs(root)
+        for i in range(self.config.files):
+            name = 'episode%02d.mkv' % (i + 1,)
+            with open(os.path.join(root, name), 'wb') as f:
+                left = self.config.fileSize * 1024 * 1024
+                while left > 0:
+                    block = os.urandom(min(left, 4 * 1024 * 1024))
+                    f.write(block)
+                    left -= len(block)
+            self.files.append('bench/' + name)
+        fs = lt.file_storage()
+        lt.add_files(fs, root)
+        ct = lt.create_torrent(fs, self.config.pieceSize * 1024)
+        ct.add_tracker(self.tracker.url)
+        lt.set_piece_hashes(ct, self.dataDir)
+        with open(self.torrentPath, 'wb') as f:
+            f.write(lt.bencode(ct.generate()))
+        logging.info('Created %d x %d MiB torrent: %s', self.config.files, self.config.fileSize, self.torrentPath)
+    def startSeed(self, host, port):
+        lt = self.lt
+        session = lt.session(lt.fingerprint('LT', lt.version_major, lt.version_minor, 0, 0),
+                             flags = int(lt.session_flags_t.add_default_plugins))
+        settings = session.get_settings()
+        settings['enable_dht'] = False
+        settings['enable_lsd'] = False
+        settings['enable_upnp'] = False
+        settings['enable_natpmp'] = False
+        settings['upload_rate_limit'] = self.config.seedRate * 1024
+        settings['allow_multiple_connections_per_ip'] = True
+        session.set_settings(settings)
+        session.listen_on(port, port, host)
+        params = {'ti': lt.torrent_info(self.torrentPath), 'save_path': self.dataDir}
+        flags = getattr(lt, 'add_torrent_params_flags_t', None)
+        if flags is not None and hasattr(flags, 'flag_seed_mode'):
+            params['flags'] = int(flags.flag_seed_mode)     # Без проверки хэшей: данные только что созданы
+        handle = session.add_torrent(params)
+        started = time.time()
+        while not handle.status().is_seeding:
+            if time.time() - started > SEED_START_TIMEOUT:
+                raise RuntimeError('Seed %s:%d did not start' % (host, port))
+            time.sleep(0.1)
+        self.sessions.append(session)
+        logging.info('Seeding on %s:%d', host, port)
+    def stop(self):
+        for session in self.sessions:
+            session.pause()
+        del self.sessions[:]
+        self.tracker.stop()
+
+#######################################################################################
+
+class Server(object):
+    '''Процесс pyrrent2http.py на свежем каталоге загрузки'''
+    def __init__(self, config, torrentPath, workDir):
+        self.config = config
+        self.port = config.httpPort
+        self.url = 'http://127.0.0.1:%d' % (self.port,)
+        self.dlPath = tempfile.mkdtemp(prefix = 'dl-', dir = workDir)
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pyrrent2http.py')
+        args = [config.python, script, '--uri', 'file://' + urllib.pathname2url(torrentPath),
+                '--dl-path', self.dlPath, '--bind', '127.0.0.1:%d' % (self.port,),
+                '--listen-port', str(config.clientPort), '--enable-dht', 'false', '--enable-lsd', 'false',
+                '--enable-upnp', 'false', '--enable-natpmp', 'false', '--file-index', '0']
+        args += shlex.split(config.serverArgs)
+        self.log = open(os.path.join(workDir, 'pyrrent2http-%d.log' % (int(time.time() * 1000),)), 'wb')
+        self.usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.process = subprocess.Popen(args, stdout = self.log, stderr = subprocess.STDOUT)
+        waitForServer(self.url, self.process)
+    def stop(self):
+        '''Останавливает процесс и возвращает его процессорное время (секунд)'''
+        try:
+            urllib.urlopen(self.url + '/shutdown').read()
+        except IOError:
+            pass
+        started = time.time()
+        while self.process.poll() is None and time.time() - started < 30:
+            time.sleep(0.1)
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.log.close()
+        shutil.rmtree(self.dlPath, ignore_errors = True)
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return (usage.ru_utime - self.usage.ru_utime) + (usage.ru_stime - self.usage.ru_stime)
+
+def waitForServer(url, process = None):
+    started = time.time()
+    while time.time() - started < SERVER_START_TIMEOUT:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError('pyrrent2http exited with code %d' % (process.returncode,))
+        try:
+            files = json.loads(urllib.urlopen(url + '/ls').read())['files']
+            if files:
+                return files
+        except (IOError, ValueError, KeyError):
+            pass
+        time.sleep(0.2)
+    raise RuntimeError('pyrrent2http did not start at %s' % (url,))
+
+#######################################################################################
+
+class Player(object):
+    '''Модель плеера. Набрав startBuffer секунд, начинает воспроизведение с битрейтом rate,
+    читает, пока запас меньше maxBuffer секунд, и останавливается (rebuffer), когда
+    воспроизведение догоняет принятое, до нового запаса в startBuffer секунд.
+    С rate = 0 читает без ограничений и лишь меряет пропускную способность'''
+    def __init__(self, rate, startBuffer, maxBuffer):
+        self.rate = rate
+        self.startBytes = rate * startBuffer
+        self.maxBytes = rate * maxBuffer
+        self.state = 'buffering'
+        self.received = 0
+        self.position = 0.0
+        self.last = None
+        self.eof = False
+        self.ttfb = None
+        self.startup = None
+        self.stalls = 0
+        self.stallTime = 0.0
+        self.stallStart = None
+    def advance(self, now):
+        if self.state == 'playing':
+            empty = self.last + (self.received - self.position) / self.rate
+            if now >= empty and not self.eof:
+                self.position = self.received
+                self.state = 'stalled'
+                self.stalls += 1
+                self.stallStart = empty
+            else:
+                self.position = min(self.position + (now - self.last) * self.rate, self.received)
+        self.last = now
+    def consume(self, now, length, started):
+        if self.ttfb is None:
+            self.ttfb = now - started
+        self.received += length
+        if self.state != 'playing' and (self.received - self.position >= self.startBytes or self.eof):
+            if self.state == 'buffering':
+                self.startup = now - started
+            else:
+                self.stallTime += now - self.stallStart
+            self.state = 'playing'
+    def play(self, response, duration):
+        '''Читает тело ответа, пока не проиграно duration секунд или не кончились данные'''
+        started = self.last = time.time()
+        while True:
+            now = time.time()
+            if self.rate > 0:
+                self.advance(now)
+                if self.position >= self.rate * duration or (self.eof and self.position >= self.received):
+                    break
+                if self.state == 'playing' and self.received - self.position >= self.maxBytes:
+                    time.sleep(min(0.1, (self.received - self.position - self.maxBytes) / self.rate + 0.01))
+                    continue
+            elif now - started >= duration or self.eof:
+                break
+            if self.eof:
+                time.sleep(0.05)
+                continue
+            data = response.read(CHUNK)
+            now = time.time()
+            if self.rate > 0:
+                self.advance(now)
+            if not data:
+                self.eof = True
+            self.consume(now, len(data), started)
+        return {'ttfb': self.ttfb, 'startup': self.startup, 'stalls': self.stalls,
+                'stall_seconds': self.stallTime, 'bytes': self.received, 'seconds': time.time() - started}
+
+class Client(object):
+    '''HTTP-клиент /files/ поверх одного keep-alive соединения'''
+    def __init__(self, url):
+        parts = urlparse.urlsplit(url)
+        self.prefix = parts.path.rstrip('/')
+        self.conn = httplib.HTTPConnection(parts.hostname, parts.port, timeout = 120)
+    def open(self, name, start = 0, end = None):
+        path = self.prefix + '/files/' + urllib.quote(name)
+        headers = {'Range': 'bytes=%d-%s' % (start, end is not None and str(end) or '')}
+        self.conn.request('GET', path, headers = headers)
+        response = self.conn.getresponse()
+        if response.status not in (200, 206):
+            raise RuntimeError('GET %s: HTTP %d' % (path, response.status))
+        return response
+    def fetch(self, name, start, length):
+        '''(время до первого байта, время до последнего) для байт [start, start + length)'''
+        started = time.time()
+        response = self.open(name, start, start + length - 1)
+        first = None
+        left = length
+        while left > 0:
+            data = response.read(min(left, CHUNK))
+            if not data:
+                raise RuntimeError('Short read of %s' % (name,))
+            if first is None:
+                first = time.time() - started
+            left -= len(data)
+        return first, time.time() - started
+    def close(self):
+        self.conn.close()
+
+#######################################################################################
+
+class Bench(object):
+    def __init__(self, config):
+        self.config = config
+        self.rate = config.bitrate * 1000 / 8
+    def player(self):
+        return Player(self.rate, self.config.startBuffer, self.config.maxBuffer)
+    def linear(self, url, files, served):
+        client = Client(url)
+        try:
+            result = self.player().play(client.open(files[0]['name']), self.config.duration)
+        finally:
+            client.close()
+        served.append(result['bytes'])
+        return {'players': [result]}
+    def probe(self, url, files, served):
+        '''Как ffprobe: заголовок, хвост с индексом, затем воспроизведение с начала'''
+        name = files[0]['name']
+        size = files[0]['size']
+        client = Client(url)
+        try:
+            head = client.fetch(name, 0, min(64 * 1024, size))
+            tailLength = min(1024 * 1024, size)
+            tail = client.fetch(name, size - tailLength, tailLength)
+            served.append(64 * 1024 + tailLength)
+            result = self.player().play(client.open(name), self.config.duration)
+        finally:
+            client.close()
+        served.append(result['bytes'])
+        return {'head_seconds': head[1], 'tail_seconds': tail[1], 'players': [result],
+                'first_frame_seconds': head[1] + tail[1] + (result['startup'] or 0)}
+    def seeks(self, url, files, served):
+        '''Воспроизведение, затем случайные перемотки: каждая читает startBuffer секунд потока'''
+        name = files[0]['name']
+        size = files[0]['size']
+        length = int(max(self.rate * self.config.startBuffer, CHUNK))
+        rand = random.Random(self.config.seed)
+        client = Client(url)
+        ttfb = list()
+        resume = list()
+        try:
+            result = self.player().play(client.open(name), min(self.config.duration, 5))
+            client.close()
+            client = Client(url)
+            served.append(result['bytes'])
+            for _ in range(self.config.seeks):
+                start = rand.randrange(0, max(size - length, 1))
+                first, last = client.fetch(name, start, min(length, size - start))
+                ttfb.append(first)
+                resume.append(last)
+                served.append(min(length, size - start))
+        finally:
+            client.close()
+        return {'players': [result], 'seek_ttfb': summary(ttfb), 'seek_to_data': summary(resume)}
+    def concurrent(self, url, files, served):
+        results = [None] * self.config.clients
+        def run(i):
+            client = Client(url)
+            try:
+                results[i] = self.player().play(client.open(files[i % len(files)]['name']), self.config.duration)
+            except Exception as e:
+                logging.error('Client %d failed: %s', i, e)
+            finally:
+                client.close()
+        threads = [threading.Thread(target = run, args = (i,)) for i in range(self.config.clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        results = [r for r in results if r is not None]
+        served.extend(r['bytes'] for r in results)
+        return {'players': results}
+    def runScenario(self, name, url, files):
+        served = list()
+        before = fetchMetrics(url)     # Счётчики накопительные: с --server сервер общий для всех сценариев
+        started = time.time()
+        result = getattr(self, name)(url, files, served)
+        elapsed = time.time() - started
+        result['served_bytes'] = sum(served)
+        result['seconds'] = elapsed
+        result['http_mbit_s'] = sum(served) * 8 / elapsed / 1e6
+        after = fetchMetrics(url)
+        result['metrics'] = dict((key, value - before.get(key, 0.0)) for key, value in after.items())
+        return result
+    def run(self):
+        config = self.config
+        results = dict()
+        if config.server:
+            files = waitForServer(config.server)
+            files = sorted(files, key = lambda f: -f['size'])
+            for name in config.scenarios:
+                logging.info('Running %s against %s', name, config.server)
+                results[name] = self.runScenario(name, config.server, files)
+            return results
+        workDir = tempfile.mkdtemp(prefix = 'pyrrent2http-bench-')
+        swarm = None
+        try:
+            swarm = Swarm(config, workDir)
+            for name in config.scenarios:
+                logging.info('Running %s', name)
+                server = Server(config, swarm.torrentPath, workDir)
+                try:
+                    files = sorted(json.loads(urllib.urlopen(server.url + '/ls').read())['files'], key = lambda f: f['name'])
+                    result = self.runScenario(name, server.url, files)
+                finally:
+                    cpu = server.stop()
+                result['cpu_seconds'] = cpu
+                result['cpu_seconds_per_gb'] = result['served_bytes'] and cpu / (result['served_bytes'] / 1e9) or None
+                results[name] = result
+        finally:
+            if swarm is not None:
+                swarm.stop()
+            shutil.rmtree(workDir, ignore_errors = True)
+        return results
+
+#######################################################################################
+
+def formatValue(value, unit = ''):
+    if value is None:
+        return '-'
+    if isinstance(value, dict):
+        return 'mean %.3f%s, p50 %.3f%s, p95 %.3f%s, max %.3f%s (%d)' % (
+            value['mean'], unit, value['p50'], unit, value['p95'], unit, value['max'], unit, value['count'])
+    if isinstance(value, float):
+        return '%.3f%s' % (value, unit)
+    return '%s%s' % (value, unit)
+
+def report(results, out):
+    for name in SCENARIOS:
+        result = results.get(name)
+        if result is None:
+            continue
+        players = result['players']
+        out.write('== %s\n' % (name,))
+        out.write('  served             %.1f MiB in %.1f s, %.1f Mbit/s\n' % (
+            result['served_bytes'] / 1048576.0, result['seconds'], result['http_mbit_s']))
+        out.write('  time to first byte %s\n' % (formatValue(summary([p['ttfb'] for p in players if p['ttfb'] is not None]), ' s'),))
+        out.write('  startup            %s\n' % (formatValue(summary([p['startup'] for p in players if p['startup'] is not None]), ' s'),))
+        out.write('  rebuffers          %d (%.2f s stalled)\n' % (
+            sum(p['stalls'] for p in players), sum(p['stall_seconds'] for p in players)))
+        for key in ('head_seconds', 'tail_seconds', 'first_frame_seconds', 'seek_ttfb', 'seek_to_data'):
+            if key in result:
+                out.write('  %-19s%s\n' % (key.replace('_', ' '), formatValue(result[key], ' s')))
+        if 'cpu_seconds' in result:
+            out.write('  cpu                %.2f s, %s s/GB\n' % (result['cpu_seconds'], formatValue(result['cpu_seconds_per_gb'])))
+        metrics = result['metrics']
+        if metrics:
+            waits = metrics.get('pyrrent2http_piece_wait_seconds_count', 0)
+            lags = metrics.get('pyrrent2http_loop_lag_seconds_count', 0)
+            out.write('  piece waits        %d, mean %s, %d timed out\n' % (waits,
+                formatValue(waits and metrics.get('pyrrent2http_piece_wait_seconds_sum', 0) / waits or None, ' s'),
+                metrics.get('pyrrent2http_piece_wait_timeouts_total', 0)))
+            out.write('  deadlines missed   %d of %d\n' % (metrics.get('pyrrent2http_piece_deadlines_missed_total', 0),
+                                                          metrics.get('pyrrent2http_piece_deadlines_total', 0)))
+            out.write('  loop lag mean      %s\n' % (formatValue(lags and metrics.get('pyrrent2http_loop_lag_seconds_sum', 0) / lags or None, ' s'),))
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Offline streaming benchmark of pyrrent2http')
+    parser.add_argument('--scenarios', type=str, default=','.join(SCENARIOS), help='Comma-separated scenarios: ' + ', '.join(SCENARIOS), dest='scenarios')
+    parser.add_argument('--server', type=str, default='', help='Benchmark an already running pyrrent2http at this URL instead of a local swarm', dest='server')
+    parser.add_argument('--files', type=int, default=2, help='Number of files in the synthetic torrent', dest='files')
+    parser.add_argument('--file-size', type=int, default=64, help='Size of each file (MiB)', dest='fileSize')
+    parser.add_argument('--piece-size', type=int, default=256, help='Piece size (KiB)', dest='pieceSize')
+    parser.add_argument('--seeders', type=int, default=2, help='Number of local seeding sessions', dest='seeders')
+    parser.add_argument('--seed-rate', type=int, default=0, help='Upload limit of each seeder (KiB/s, 0 = unlimited)', dest='seedRate')
+    parser.add_argument('--seed-port', type=int, default=47000, help='Listen port of the first seeder', dest='seedPort')
+    parser.add_argument('--client-port', type=int, default=47100, help='Listen port of pyrrent2http', dest='clientPort')
+    parser.add_argument('--http-port', type=int, default=47200, help='HTTP port of pyrrent2http', dest='httpPort')
+    parser.add_argument('--server-args', type=str, default='', help='Extra pyrrent2http options, e.g. "--async-http"', dest='serverArgs')
+    parser.add_argument('--python', type=str, default=sys.executable, help='Interpreter for pyrrent2http.py', dest='python')
+    parser.add_argument('--bitrate', type=int, default=8000, help='Playback bitrate (kbit/s, 0 = read as fast as possible)', dest='bitrate')
+    parser.add_argument('--duration', type=float, default=20, help='Seconds of playback per player', dest='duration')
+    parser.add_argument('--start-buffer', type=float, default=2, help='Seconds of stream a player buffers before (re)starting playback', dest='startBuffer')
+    parser.add_argument('--max-buffer', type=float, default=30, help='Seconds of stream a player reads ahead', dest='maxBuffer')
+    parser.add_argument('--seeks', type=int, default=10, help='Number of random seeks', dest='seeks')
+    parser.add_argument('--clients', type=int, default=2, help='Number of concurrent clients', dest='clients')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed of seek positions', dest='seed')
+    parser.add_argument('--json', type=str, default='', help='Also write raw results to this JSON file', dest='json')
+    config = parser.parse_args()
+    config.scenarios = [s.strip() for s in config.scenarios.split(',') if s.strip()]
+    for name in config.scenarios:
+        if name not in SCENARIOS:
+            parser.error('Unknown scenario: %s' % (name,))
+    if config.server:
+        config.server = config.server.rstrip('/')
+    results = Bench(config).run()
+    report(results, sys.stdout)
+    if config.json:
+        with open(config.json, 'wb') as f:
+            json.dump(results, f, indent = 2, sort_keys = True)
+
+if __name__ == '__main__':
+    main()
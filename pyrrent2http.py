@@ -16,14 +16,39 @@ except:
         sys.exit(1)
 from random import SystemRandom
 import time
-import urlparse, urllib
+import urlparse, urllib, urllib2, httplib
+import email.utils
+import hashlib
 import platform
 import BaseHTTPServer
 import SocketServer
 import threading
 import signal
+import heapq
+import itertools
+import math
+import Queue
 import io
+import struct
 import socket
+import mmap
+import asyncore
+import select
+import errno
+import collections
+import cStringIO
+import zlib
+import re
+import base64, binascii
+try:
+    from os import sendfile
+except ImportError:
+    try:
+        from sendfile import sendfile   # pysendfile для Python 2
+    except ImportError:
+        sendfile = None
+import tempfile
+import shutil
 
 
 logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.DEBUG)
@@ -93,96 +118,1064 @@ AVOID_HTTP_SERVER_EXCEPTION_OUTPUT = True
 VERSION = "0.5.0"
 USER_AGENT = "pyrrent2http/" + VERSION + " libtorrent/" + lt.version
 
+MAX_LOOP_WAIT = 1.0     # секунд; как часто главный цикл проверяет forceShutdown
+SESSION_STATS_INTERVAL = 5.0    # секунд между session_stats_alert для /metrics
+READAHEAD_MIN_BYTES = 4 * 1024 * 1024
+READAHEAD_MAX_BYTES = 256 * 1024 * 1024
+# Перемотка за окно упреждения сначала считается пробой (плеер читает индекс, субтитры,
+# ищет ключевой кадр): окно переезжает, только когда с нового места прочитано
+# SEEK_SETTLE_BYTES или прошло SEEK_SETTLE_SECONDS, а до тех пор качаются SEEK_SEED_PIECES кусков
+SEEK_SETTLE_BYTES = 1024 * 1024
+SEEK_SETTLE_SECONDS = 2.0
+SEEK_SEED_PIECES = 4
+STREAM_CHUNK = 4 * 1024 * 1024     # максимум байт, отдаваемых в сокет за один заход
+HTTP_KEEPALIVE_TIMEOUT = 60.0   # секунд; сколько соединение keep-alive ждёт следующего запроса
+HTTP_IDLE_RELEASE = 5.0         # секунд простоя соединения, после которых закрывается открытый им файл
+FILE_PRIORITY = 2       # приоритет открытых файлов, чтобы упреждающей загрузке следующих оставался приоритет ниже
+PREFETCH_PRIORITY = 1   # куски начала и индекса файлов --prefetch-next и /prefetch
+PIECE_FLUSH_GRACE = 5.0     # секунд после piece_finished_alert, пока кусок может быть только в кэше записи libtorrent
+PIECE_WAIT_HOLD = 5.0       # секунд; столько cancelStray() не трогает срочный дедлайн куска, которого ждёт читатель
+READ_PIECE_TIMEOUT = 10.0   # секунд; сколько ждать read_piece_alert, прежде чем вызвать read_piece снова
+READ_PIECE_RESULTS = 4      # сколько последних ответов read_piece держать для читателей мимо кэша
+REMOVE_ATTEMPTS = 20    # сколько раз housekeeping пробует удалить файлы торрента, убранного через /remove
+MAX_TORRENT_SIZE = 16 * 1024 * 1024     # больше .torrent по HTTP не скачиваем
+
 VIDEO_EXTS={'.avi':'video/x-msvideo','.mp4':'video/mp4','.mkv':'video/x-matroska',
 '.m4v':'video/mp4','.mov':'video/quicktime', '.mpg':'video/mpeg','.ogv':'video/ogg',
 '.ogg':'video/ogg', '.webm':'video/webm', '.ts': 'video/mp2t', '.3gp':'video/3gpp'}
+# Сколько байт с начала и с конца файла плеер читает до первого кадра:
+# заголовки, атом moov у MP4, Cues у MKV, индекс idx1 у AVI
+CONTAINER_PREFETCH={'.mp4':(1024*1024, 4*1024*1024), '.m4v':(1024*1024, 4*1024*1024),
+'.mov':(1024*1024, 4*1024*1024), '.3gp':(1024*1024, 4*1024*1024),
+'.mkv':(1024*1024, 2*1024*1024), '.webm':(1024*1024, 2*1024*1024),
+'.avi':(1024*1024, 1024*1024), '.ogv':(512*1024, 256*1024), '.ogg':(512*1024, 256*1024),
+'.mpg':(512*1024, 0), '.ts':(512*1024, 0)}
+MP4_EXTS = ('.mp4', '.m4v', '.mov', '.3gp')
+# Серии скачанных кусков внутри байта битовой карты: значение байта -> [(бит, длина)]
+BYTE_RUNS = [[(m.start(), m.end() - m.start()) for m in re.finditer('1+', '{0:08b}'.format(b))] for b in range(256)]
+PIECE_RUNS = re.compile(r'\xff+|[^\x00\xff]')
+MISSING_BYTES = re.compile(r'[^\xff]')
 ######################################################################################
 
-class Ticker(object):
+class Scheduler(object):
+    '''Периодические задачи главного цикла на куче таймеров.
+    Главный цикл спит в session.wait_for_alert() до ближайшей задачи'''
+    def __init__(self):
+        self.jobs = list()
+        self.counter = itertools.count()
+
+    def every(self, interval, func):
+        if interval <= 0:
+            return
+        heapq.heappush(self.jobs, (time.time() + interval, next(self.counter), interval, func))
+
+    def timeout(self):
+        '''Сколько секунд осталось до ближайшей задачи'''
+        if not self.jobs:
+            return None
+        return max(self.jobs[0][0] - time.time(), 0)
+
+    def runPending(self):
+        '''Выполняет созревшие задачи и возвращает наибольшее опоздание (секунд) или None'''
+        now = time.time()
+        lag = None
+        while self.jobs and self.jobs[0][0] <= now:
+            due, _, interval, func = heapq.heappop(self.jobs)
+            lag = max(lag, now - due)
+            try:
+                func()
+            except Exception:
+                logging.exception('Scheduled job %s failed', func.__name__)
+            # Не догоняем пропущенные тики пачкой, если задача затянулась
+            heapq.heappush(self.jobs, (max(due + interval, now), next(self.counter), interval, func))
+        return lag
+
+def writeFileAtomic(path, data):
+    '''Заменяет файл целиком: временный файл в том же каталоге, fsync, rename.
+    При падении на диске остаётся либо старая, либо новая версия'''
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmpPath = tempfile.mkstemp(prefix = '.' + os.path.basename(path) + '.', suffix = '.tmp', dir = directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        if platform.system().lower() == 'windows' and os.path.exists(path):
+            os.remove(path)     # rename в Windows не заменяет существующий файл
+        os.rename(tmpPath, path)
+    except:
+        try:
+            os.remove(tmpPath)
+        except OSError:
+            pass
+        raise
+    if hasattr(os, 'O_DIRECTORY'):
+        # Сам rename тоже должен пережить падение
+        dirFd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dirFd)
+        finally:
+            os.close(dirFd)
+
+class TorrentFetch(object):
+    '''Скачивает .torrent по HTTP в отдельном потоке, пока запускаются сессия и DHT.
+    С --torrent-cache ответ хранится на диске: пока он свеж по Cache-Control/Expires,
+    сеть не нужна, потом он перепроверяется по ETag и Last-Modified,
+    а при ошибке сети (но не ответе сервера с ошибкой) используется как есть'''
+    def __init__(self, root, uri):
+        self.root = root
+        self.uri = uri
+        self.data = None
+        self.error = None
+        self.thread = threading.Thread(target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+    def result(self):
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.data
+    def run(self):
+        try:
+            self.data = self.fetch()
+        except Exception as e:
+            self.error = e
+    def cachePath(self):
+        cacheDir = self.root.config.torrentCache
+        return cacheDir != '' and os.path.join(cacheDir, hashlib.sha1(self.uri).hexdigest() + '.cache') or None
+    def loadCache(self):
+        '''(сведения о кэшированном ответе, тело) или (None, None)'''
+        path = self.cachePath()
+        if path is None or not os.path.exists(path):
+            return None, None
+        try:
+            with open(path, 'rb') as f:
+                meta, data = f.read().split('\n', 1)
+            return json.loads(meta), data
+        except (IOError, ValueError) as e:
+            logging.error('Ignoring broken torrent cache %s: %s', path, e)
+            return None, None
+    def saveCache(self, headers, data):
+        path = self.cachePath()
+        if path is None:
+            return
+        meta = {'etag': headers.getheader('ETag'), 'last_modified': headers.getheader('Last-Modified'),
+                'expires': self.expires(headers)}
+        self.writeCache(path, meta, data)
+    def writeCache(self, path, meta, data):
+        # Сразу и в этом потоке: StateWriter запускается позже, а процесс может завершиться раньше его записи
+        try:
+            writeFileAtomic(path, json.dumps(meta) + '\n' + data)
+        except (IOError, OSError) as e:
+            logging.error('Failed to write %s: %s', path, e)
+    def expires(self, headers):
+        '''До какого времени ответ можно брать из кэша без запроса'''
+        cacheControl = [d.strip().lower() for d in (headers.getheader('Cache-Control') or '').split(',')]
+        if 'no-cache' in cacheControl or 'no-store' in cacheControl:
+            return 0
+        for directive in cacheControl:
+            if directive.startswith('max-age='):
+                try:
+                    return time.time() + int(directive[len('max-age='):])
+                except ValueError:
+                    return 0
+        expires = email.utils.parsedate_tz(headers.getheader('Expires') or '')
+        return expires is not None and email.utils.mktime_tz(expires) or 0
+    def fetch(self):
+        meta, cached = self.loadCache()
+        if cached is not None and time.time() < meta.get('expires', 0):
+            logging.info('Using cached torrent for %s', self.uri)
+            return cached
+        try:
+            return self.download(meta, cached)
+        except urllib2.HTTPError:
+            raise   # Сервер ответил, и 404 или 403 старая копия не исправит
+        except (IOError, socket.error, httplib.HTTPException) as e:
+            if cached is None:
+                raise
+            logging.warning('Failed to fetch %s (%s), using cached torrent', self.uri, e)
+            return cached
+    def download(self, meta, cached):
+        config = self.root.config
+        request = urllib2.Request(self.uri, headers = {'User-Agent': config.userAgent})
+        if cached is not None:
+            if meta.get('etag'):
+                request.add_header('If-None-Match', meta['etag'])
+            if meta.get('last_modified'):
+                request.add_header('If-Modified-Since', meta['last_modified'])
+        try:
+            # Таймаут и на соединение, и на каждое чтение из сокета
+            response = urllib2.urlopen(request, timeout = config.fetchTimeout)
+        except urllib2.HTTPError as e:
+            if e.code != 304 or cached is None:
+                raise
+            logging.info('Cached torrent for %s is not modified', self.uri)
+            meta['expires'] = self.expires(e.info())
+            self.writeCache(self.cachePath(), meta, cached)
+            return cached
+        try:
+            deadline = time.time() + config.fetchTimeout * 4    # медленная отдача по байту тоже не вечна
+            chunks = []
+            size = 0
+            while True:
+                chunk = response.read(64 * 1024)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > MAX_TORRENT_SIZE:
+                    raise IOError('Torrent at %s is too large' % (self.uri,))
+                if time.time() > deadline:
+                    raise IOError('Timed out fetching %s' % (self.uri,))
+                chunks.append(chunk)
+            data = ''.join(chunks)
+            self.saveCache(response.info(), data)
+            return data
+        finally:
+            response.close()
+
+def magnetInfoHash(uri):
+    '''infohash магнита (hex, в нижнем регистре) или None'''
+    for xt in urlparse.parse_qs(urlparse.urlsplit(uri).query).get('xt', []):
+        if not xt.lower().startswith('urn:btih:'):
+            continue
+        value = xt[len('urn:btih:'):]
+        if len(value) == 40:
+            return value.lower()
+        if len(value) == 32:
+            try:
+                return binascii.hexlify(base64.b32decode(value.upper()))
+            except TypeError:
+                pass
+    return None
+
+class StateWriter(object):
+    '''Фоновая запись resume data и состояния сессии, чтобы fsync не задерживал главный цикл.
+    Для каждого файла хранится только последняя версия данных, и пишется она
+    не чаще раза в interval секунд'''
     def __init__(self, interval):
-        self.tick = False
-        self._timer     = None
-        self.interval   = interval
-        self.is_running = False
-        self.start()
-
-    def true(self):
-        if self.tick:
-            self.tick = False
-            return True
+        self.interval = interval
+        self.cond = threading.Condition()
+        self.pending = dict()   # путь -> данные
+        self.written = dict()   # путь -> когда файл записан в последний раз
+        self.stopped = False
+        self.thread = threading.Thread(target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+    def save(self, path, data):
+        with self.cond:
+            self.pending[path] = data
+            self.cond.notify()
+    def close(self, timeout):
+        '''Дописывает отложенное без ограничения частоты и останавливает поток'''
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        self.thread.join(timeout)
+    def ready(self, now):
+        return [path for path in self.pending if self.stopped or now >= self.written.get(path, 0) + self.interval]
+    def run(self):
+        while True:
+            with self.cond:
+                while True:
+                    if self.stopped and not self.pending:
+                        return
+                    now = time.time()
+                    paths = self.ready(now)
+                    if paths:
+                        break
+                    due = [self.written[path] + self.interval for path in self.pending]
+                    self.cond.wait(due and max(min(due) - now, 0.01) or None)
+                items = [(path, self.pending.pop(path)) for path in paths]
+                for path in paths:
+                    self.written[path] = now
+            for path, data in items:
+                try:
+                    writeFileAtomic(path, data)
+                except (IOError, OSError) as e:
+                    logging.error('Failed to write %s: %s', path, e)
+
+#######################################################################################
+
+class PieceDispatcher(object):
+    '''Будит потоки, ожидающие конкретный кусок. Кормится из consumeAlerts
+    (piece_finished_alert / read_piece_alert), вместо опроса have_piece()'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiters = dict()
+    def register(self, piece, event = None):
+        '''event - любой объект с методом set(), по умолчанию threading.Event'''
+        if event is None:
+            event = threading.Event()
+        with self.lock:
+            self.waiters.setdefault(piece, []).append(event)
+        return event
+    def unregister(self, piece, event):
+        with self.lock:
+            events = self.waiters.get(piece)
+            if events is not None and event in events:
+                events.remove(event)
+                if not events:
+                    del self.waiters[piece]
+    def notify(self, piece):
+        with self.lock:
+            events = self.waiters.pop(piece, [])
+        for event in events:
+            event.set()
+    def wakeAll(self):
+        '''Ложное пробуждение всех ожидающих: они перепроверят таймаут,
+        приоритет куска и закрытие файла'''
+        with self.lock:
+            waiters = self.waiters
+            self.waiters = dict()
+        for events in waiters.values():
+            for event in events:
+                event.set()
+
+#######################################################################################
+
+EVENTS_KEEPALIVE = 15.0     # секунд; пинг /events и таймаут long-poll
+
+class EventBus(object):
+    '''Журнал событий для /events: состояние и скорости торрентов, прогресс файлов,
+    буфер перед курсором чтения. Публикует главный цикл, подписчики - любые
+    объекты с методом set(), как у PieceDispatcher'''
+    HISTORY = 1024
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = collections.deque(maxlen = self.HISTORY)
+        self.seq = 0
+        self.listeners = set()
+    def publish(self, kind, data):
+        with self.lock:
+            self.seq += 1
+            self.events.append((self.seq, kind, data))
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener.set()
+    def since(self, seq, infoHash = None):
+        '''(события с номером больше seq, последний номер). infoHash оставляет события
+        одного торрента. Если часть событий уже вытеснена из журнала, первым идёт
+        событие reset: клиенту стоит перечитать /status и /ls'''
+        with self.lock:
+            events = [event for event in self.events if event[0] > seq
+                      and (infoHash is None or event[2].get('info_hash', infoHash) == infoHash)]
+            if self.events and seq < self.events[0][0] - 1:
+                events.insert(0, (self.events[0][0] - 1, 'reset', {}))
+            return events, self.seq
+    def allocate(self, count):
+        '''Номера для count событий, отправляемых одному клиенту мимо журнала
+        (начальное состояние SSE). Возвращает первый из них'''
+        with self.lock:
+            first = self.seq + 1
+            self.seq += count
+            return first
+    def subscribe(self, listener):
+        with self.lock:
+            self.listeners.add(listener)
+    def unsubscribe(self, listener):
+        with self.lock:
+            self.listeners.discard(listener)
+    def keepAlive(self):
+        '''Будит подписчиков без новых событий: SSE шлёт пинг, long-poll отвечает пустым списком'''
+        with self.lock:
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener.set()
+
+def formatEvents(events):
+    '''События в формате text/event-stream'''
+    out = list()
+    for seq, kind, data in events:
+        out.append('id: %d\nevent: %s\ndata: %s\n\n' % (seq, kind, json.dumps(data)))
+    return ''.join(out)
+
+def jsonEvents(events):
+    return [{'seq': seq, 'event': kind, 'data': data} for seq, kind, data in events]
+
+#######################################################################################
+
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+METRICS = (
+    ('pyrrent2http_piece_wait_seconds', 'histogram', 'Time HTTP readers spent waiting for a missing piece'),
+    ('pyrrent2http_piece_wait_timeouts_total', 'counter', 'Piece waits given up after --piece-wait-timeout'),
+    ('pyrrent2http_read_seconds', 'histogram', 'Latency of serving one chunk of a /files/ response, including piece waits'),
+    ('pyrrent2http_read_bytes_total', 'counter', 'Bytes read from disk or the piece cache for /files/ responses'),
+    ('pyrrent2http_piece_read_seconds', 'histogram', 'Latency of loading a piece into the piece cache'),
+    ('pyrrent2http_http_bytes_total', 'counter', 'Bytes of /files/ response bodies sent, by file'),
+    ('pyrrent2http_piece_deadlines_total', 'counter', 'Piece deadlines set'),
+    ('pyrrent2http_piece_deadlines_missed_total', 'counter', 'Pieces that finished after their deadline'),
+    ('pyrrent2http_seeks_total', 'counter', 'Seeks of opened files'),
+    ('pyrrent2http_loop_lag_seconds', 'histogram', 'Lateness of main loop jobs'),
+)
+
+def formatLabel(value):
+    # Имена файлов приходят байтовыми строками UTF-8
+    if isinstance(value, str):
+        value = value.decode('utf-8', 'replace')
+    else:
+        value = unicode(value)
+    return value.encode('utf-8').replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def formatLabels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, formatLabel(v)) for k, v in labels)
+
+def formatValue(value):
+    '''Значение сэмпла: repr() дал бы 10L для long'''
+    if isinstance(value, (int, long)):
+        return '%d' % value
+    return repr(float(value))
+
+class Metrics(object):
+    '''Счётчики и гистограммы для /metrics в текстовом формате Prometheus'''
+    def __init__(self, declarations):
+        self.lock = threading.Lock()
+        self.declarations = declarations
+        self.samples = dict((name, dict()) for name, _, _ in declarations)
+    def inc(self, name, value = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            samples = self.samples[name]
+            samples[key] = samples.get(key, 0) + value
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            samples = self.samples[name]
+            sample = samples.get(key)
+            if sample is None:
+                sample = samples[key] = [[0] * len(HISTOGRAM_BUCKETS), 0.0, 0]
+            for i, bound in enumerate(HISTOGRAM_BUCKETS):
+                if value <= bound:
+                    sample[0][i] += 1
+            sample[1] += value
+            sample[2] += 1
+    def render(self, extra = ()):
+        '''extra - [(имя, тип, описание, [(метки, значение)])], значения, собираемые при запросе'''
+        lines = list()
+        with self.lock:
+            for name, kind, description in self.declarations:
+                lines.append('# HELP %s %s' % (name, description))
+                lines.append('# TYPE %s %s' % (name, kind))
+                for labels, sample in sorted(self.samples[name].items()):
+                    if kind != 'histogram':
+                        lines.append('%s%s %s' % (name, formatLabels(labels), formatValue(sample)))
+                        continue
+                    for bound, count in zip(HISTOGRAM_BUCKETS, sample[0]):
+                        lines.append('%s_bucket%s %d' % (name, formatLabels(labels + (('le', repr(bound)),)), count))
+                    lines.append('%s_bucket%s %d' % (name, formatLabels(labels + (('le', '+Inf'),)), sample[2]))
+                    lines.append('%s_sum%s %s' % (name, formatLabels(labels), formatValue(sample[1])))
+                    lines.append('%s_count%s %d' % (name, formatLabels(labels), sample[2]))
+        for name, kind, description, samples in extra:
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in samples:
+                lines.append('%s%s %s' % (name, formatLabels(labels), formatValue(value)))
+        return '\n'.join(lines) + '\n'
+
+#######################################################################################
+
+class ReadAhead(object):
+    '''Окно упреждающей загрузки открытого файла.
+    Скорость потребления оценивается по тому, как быстро HTTP-обработчик
+    продвигает смещение чтения, скорость поступления - по status().download_rate,
+    поделённой между читателями торрента пропорционально их потреблению'''
+    SAMPLE_INTERVAL = 1.0   # секунд между замерами скорости потребления
+    SMOOTHING = 0.3         # вес нового замера в скользящем среднем
+    def __init__(self, tf, seconds):
+        self.tf = tf
+        self.seconds = seconds
+        self.consumeRate = 0.0
+        self.sampleOffset = None
+        self.sampleTime = None
+    def reset(self, offset):
+        self.sampleOffset = offset
+        self.sampleTime = time.time()
+    def advance(self, offset):
+        if self.sampleTime is None or offset < self.sampleOffset:
+            self.reset(offset)
+            return
+        dt = time.time() - self.sampleTime
+        if dt < self.SAMPLE_INTERVAL:
+            return
+        rate = (offset - self.sampleOffset) / dt
+        if self.consumeRate > 0:
+            self.consumeRate += self.SMOOTHING * (rate - self.consumeRate)
         else:
-            return False
+            self.consumeRate = rate
+        self.reset(offset)
+    def supplyRate(self, readers = None):
+        tfs = self.tf.tfs
+        if readers is None:
+            readers = tfs.activeReaders()
+        total = sum(f.readAhead.consumeRate for f in readers if f.readAhead.consumeRate > 0)
+        if self.consumeRate > 0 and total > 0:
+            return tfs.downloadRate * self.consumeRate / total
+        return tfs.downloadRate / max(len(readers), 1)
+    def bufferSeconds(self):
+        '''На сколько секунд воспроизведения хватит скачанного подряд от курсора, None - неизвестно'''
+        if self.consumeRate <= 0:
+            return None
+        return self.tf.bufferedPieces() * self.tf.piece_length / self.consumeRate
+    def windowBytes(self, readers = None):
+        if self.consumeRate <= 0:
+            return READAHEAD_MIN_BYTES
+        window = self.consumeRate * self.seconds
+        supply = self.supplyRate(readers)
+        if 0 < supply < self.consumeRate:
+            # Рой не успевает за плеером: не заказываем больше, чем он отдаст за то же время
+            window = supply * self.seconds
+        return min(max(window, READAHEAD_MIN_BYTES), READAHEAD_MAX_BYTES)
+    def windowPieces(self, readers = None):
+        return max(int(math.ceil(self.windowBytes(readers) / float(self.tf.piece_length))), 2)
+    def deadline(self, distance, readers):
+        '''Дедлайн (мс) для куска, до которого плеер дочитает через distance байт.
+        readers - activeReaders(), взятые один раз на проход DeadlineManager'''
+        rate = self.consumeRate
+        if rate <= 0 and len(readers) > 1:
+            # Читатель с неизвестной скоростью (миниатюры, пробы) не должен
+            # получать самые срочные дедлайны в ущерб соседнему потоку
+            rate = self.supplyRate(readers)
+        if rate <= 0:
+            return 70 + 20 * (distance // self.tf.piece_length)
+        return max(int(1000 * distance / rate), 70)
 
-    def _run(self):
-        self.is_running = False
-        self.start()
-        self.tick = True
+#######################################################################################
 
-    def start(self):
-        if not self.is_running:
-            self._timer = threading.Timer(self.interval, self._run)
-            self._timer.start()
-            self.is_running = True
+def pieceRangeDifference(a, b):
+    '''Куски полуинтервала a, не входящие в полуинтервал b'''
+    if b[0] >= b[1]:
+        return xrange(a[0], a[1])
+    return itertools.chain(xrange(a[0], min(a[1], b[0])), xrange(max(a[0], b[1]), a[1]))
 
+class DeadlineManager(object):
+    '''Единственный долгоживущий поток TorrentFS, расставляющий дедлайны кусков сразу для всех читателей.
+    Читатели лишь сообщают через очередь, с какого куска они теперь читают.
+    Дедлайн куска - момент, когда до него дочитает ближайший читатель, так что libtorrent
+    сначала качает то, что понадобится раньше, какому бы потоку оно ни было нужно.
+    Раз в RESCHEDULE_INTERVAL дедлайны пересчитываются (у остановленного плеера они
+    не должны становиться просроченными и отнимать рой у соседей), а файлы читателей,
+    у которых запас меньше URGENT_BUFFER окна упреждения, получают высший приоритет.
+    Когда окно читателя скачано хотя бы на FILL_START, куски сразу за окном
+    по порядку получают приоритет 7 (докачка), пока запас снова не упадёт
+    ниже URGENT_BUFFER: перемотка вперёд попадает на уже скачанное'''
+    RESCHEDULE_INTERVAL = 1.0
+    URGENT_BUFFER = 0.5
+    FILL_START = 0.9
+    FILL_MIN_PIECES = 8
+    def __init__(self, tfs):
+        self.tfs = tfs
+        self.queue = Queue.Queue()
+        self.windows = dict()   # читатель -> полуинтервал кусков его окна
+        self.readers = dict()   # кусок -> сколько окон его включают
+        self.filling = set()    # читатели с достаточным запасом, для которых идёт докачка
+        self.probes = dict()    # читатель -> куски с дедлайнами у места пробной перемотки
+        self.filled = dict()    # кусок докачки -> индекс файла
+        self.raised = set()     # индексы файлов, поднятых reschedule() до приоритета 7
+        self.active = list()    # activeReaders() на текущий проход
+        self.thread = threading.Thread(target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+    def request(self, tf, piece):
+        self.queue.put((tf, piece, False))
+    def probe(self, tf, piece):
+        '''Дедлайны нескольким кускам с piece, не трогая окно читателя'''
+        self.queue.put((tf, piece, True))
+    def release(self, tf):
+        self.queue.put((tf, None, False))
+    def inWindow(self, tf, piece):
+        window = self.windows.get(tf)
+        return window is not None and window[0] <= piece < window[1]
     def stop(self):
-        self._timer.cancel()
-        self.is_running = False
+        self.queue.put(None)
+    def run(self):
+        nextReschedule = time.time() + self.RESCHEDULE_INTERVAL
+        while True:
+            items = list()
+            try:
+                items.append(self.queue.get(timeout = max(nextReschedule - time.time(), 0)))
+                while True:
+                    items.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+            if None in items:
+                return
+            # Схлопываем очередь: важен только последний запрос каждого читателя,
+            # проба, за которой последовал переезд окна, уже не нужна
+            windows = dict()
+            probes = dict()
+            for tf, piece, probe in items:
+                if probe:
+                    probes[tf] = piece
+                else:
+                    windows[tf] = piece
+                    probes.pop(tf, None)
+            self.active = self.tfs.activeReaders()
+            try:
+                for tf, piece in windows.items():
+                    self.update(tf, piece)
+                for tf, piece in probes.items():
+                    self.seed(tf, piece)
+                if items:
+                    self.cancelStray()
+            except Exception:
+                logging.exception('Failed to update piece deadlines')
+            if time.time() >= nextReschedule:
+                try:
+                    self.reschedule()
+                except Exception:
+                    logging.exception('Failed to reschedule piece deadlines')
+                nextReschedule = time.time() + self.RESCHEDULE_INTERVAL
+    def seed(self, tf, piece):
+        self.dropProbe(tf)
+        if tf.closed:
+            return
+        pieces = range(piece, min(piece + SEEK_SEED_PIECES, tf.endPiece + 1))
+        for p in pieces:
+            if not self.tfs.havePiece(p):
+                self.tfs.setPieceDeadline(p, tf.readAhead.deadline((p - piece) * tf.piece_length, self.active))
+        self.probes[tf] = pieces
+    def dropProbe(self, tf):
+        for p in self.probes.pop(tf, ()):
+            if p not in self.readers and not self.tfs.havePiece(p):
+                self.tfs.resetPieceDeadline(p)
+    def cancelStray(self):
+        '''Снимает дедлайны, оставшиеся от мест, откуда уже не читают (например, от
+        waitForPiece() перед перемоткой), кроме закреплённых кусков индекса
+        и кусков, которых читатели ждут прямо сейчас'''
+        tfs = self.tfs
+        probed = set(itertools.chain.from_iterable(self.probes.values()))
+        now = time.time()
+        for p in list(tfs.deadlineDue):
+            if p in self.readers or p in probed or p in tfs.pinnedPieces:
+                continue
+            held = tfs.heldPieces.get(p)
+            if held is not None:
+                if held > now:
+                    continue
+                tfs.heldPieces.pop(p, None)     # Читатель перестал ждать
+            if not tfs.havePiece(p):
+                tfs.resetPieceDeadline(p)
+    def due(self, piece):
+        '''Дедлайн куска (мс) по ближайшему к нему читателю'''
+        return min(tf.readAhead.deadline((piece - start) * tf.piece_length, self.active)
+                   for tf, (start, end) in self.windows.items() if start <= piece < end)
+    def reschedule(self):
+        tfs = self.tfs
+        now = time.time()
+        for p in list(self.readers):
+            if tfs.havePiece(p):
+                continue
+            ms = self.due(p)
+            old = tfs.deadlineDue.get(p)
+            if old is None or abs(now + ms / 1000.0 - old) > max(0.5, ms / 4000.0):
+                tfs.setPieceDeadline(p, ms)
+        urgency = dict()    # файл -> есть ли у него читатель на исходе запаса
+        for tf in self.windows:
+            if tf.closed:
+                continue
+            buffered = tf.readAhead.bufferSeconds()
+            urgent = buffered is not None and buffered < tf.readAhead.seconds * self.URGENT_BUFFER
+            urgency[tf.index] = urgency.get(tf.index, False) or urgent
+        # Файлы делят полосу, только пока читателей несколько; поднятый до 7 файл
+        # возвращается к FILE_PRIORITY, когда его сосед закрыт. Закрытые файлы (приоритет 0) не трогаем
+        raised = set()
+        if len(urgency) > 1:
+            raised = set(index for index, urgent in urgency.items() if urgent)
+        with tfs.prioritiesLock:
+            for index in set(urgency) | self.raised:
+                if tfs.priorities[index] != 0 and (len(urgency) > 1 or index in self.raised):
+                    tfs.setPriority(index, index in raised and 7 or FILE_PRIORITY)
+        self.raised = raised
+        self.fill()
+    def fill(self):
+        '''Приоритет 7 следующим за окнами читателей нескачанным кускам их файлов'''
+        tfs = self.tfs
+        handle = tfs.handle
+        wanted = dict()
+        if tfs.memoryStorage is None and tfs.pieceMap is not None:
+            for tf, (start, end) in self.windows.items():
+                if tf.closed:
+                    continue
+                buffered = tf.bufferedPieces()
+                if buffered >= (end - start) * self.FILL_START:
+                    self.filling.add(tf)
+                elif buffered < (end - start) * self.URGENT_BUFFER:
+                    self.filling.discard(tf)
+                if tf in self.filling:
+                    for p in tfs.pieceMap.missing(end, tf.endPiece + 1 - end, max(end - start, self.FILL_MIN_PIECES)):
+                        wanted[p] = tf.index
+        self.filling.intersection_update(self.windows)
+        for p, index in self.filled.items():
+            if p not in wanted and not tfs.havePiece(p):
+                handle.piece_priority(p, handle.file_priority(index))
+        for p in wanted:
+            # file_priority() сбрасывает приоритеты кусков файла, так что проверяем каждый раз
+            if handle.piece_priority(p) != 7:
+                handle.piece_priority(p, 7)
+        self.filled = wanted
+    def update(self, tf, piece):
+        tfs = self.tfs
+        self.dropProbe(tf)
+        old = self.windows.pop(tf, (0, 0))
+        if piece is None or tf.closed:
+            new = (0, 0)
+        else:
+            new = (piece, min(piece + 1 + tf.readAhead.windowPieces(self.active), tf.endPiece + 1))
+        if new[0] < new[1]:
+            self.windows[tf] = new
+        now = time.time()
+        for p in pieceRangeDifference(new, old):
+            count = self.readers.get(p, 0)
+            self.readers[p] = count + 1
+            if tfs.havePiece(p):
+                continue
+            ms = tf.readAhead.deadline((p - piece) * tf.piece_length, self.active)
+            # Кусок уже в окне другого читателя: дедлайн переносится, только если нам он нужен раньше
+            if count == 0 or now + ms / 1000.0 < tfs.deadlineDue.get(p, 0):
+                tfs.setPieceDeadline(p, ms)
+        for p in pieceRangeDifference(old, new):
+            count = self.readers.pop(p) - 1
+            if count > 0:
+                self.readers[p] = count
+            elif not tfs.havePiece(p):
+                tfs.resetPieceDeadline(p)
+
+#######################################################################################
+
+class Mp4IndexLocator(object):
+    '''Ищет атом moov, перебирая заголовки атомов верхнего уровня MP4.
+    Недостающий кусок с очередным заголовком заказывается с коротким дедлайном,
+    а продолжение поиска вызывает PieceDispatcher, когда кусок скачан.
+    Заголовки читает собственный поток локатора (PieceDispatcher лишь будит его
+    из цикла алертов) через свой TorrentFile, так что поиск не зависит от закрытия файла плеером'''
+    MAX_BOXES = 64
+    def __init__(self, tf):
+        self.tf = TorrentFile(tf.tfs, tf.meta)
+        self.tf.num = tf.num
+        self.tf.closed = False
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.pos = 0
+        self.boxes = 0
+        self.done = False
+        self.requested = set()
+    def start(self):
+        with self.lock:
+            if self.thread is None and not self.done:
+                self.thread = threading.Thread(target = self.run)
+                self.thread.daemon = True
+                self.thread.start()
+        self.wakeup.set()
+    def set(self):
+        self.wakeup.set()
+    def run(self):
+        tfs = self.tf.tfs
+        while not self.done and not tfs.shuttingDown:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            if tfs.shuttingDown:
+                break
+            try:
+                waiting = self.step()
+            except Exception:
+                logging.exception('Failed to locate moov in %s' % (self.tf.SavePath(),))
+                waiting = False
+                self.done = True
+            if not waiting and self.tf.filePtr is not None:
+                self.tf.filePtr.close()
+                self.tf.filePtr = None
+        if self.tf.filePtr is not None:
+            self.tf.filePtr.close()
+            self.tf.filePtr = None
+    def read(self, offset, length):
+        data = ''
+        while len(data) < length:
+            chunk = self.tf.readAt(offset + len(data), length - len(data))
+            if len(chunk) == 0:
+                break
+            data += chunk.tobytes()
+        return data
+    def step(self):
+        '''True, если поиск ждёт кусок'''
+        tf = self.tf
+        # Плеер часто закрывает соединение после пробного чтения, поэтому поиск
+        # продолжается и после закрытия файла, пока файл нужен торренту;
+        # повторное открытие файла продолжает его с того же места
+        while self.pos + 8 <= tf.size and self.boxes < self.MAX_BOXES:
+            if tf.tfs.shuttingDown or tf.tfs.priorities[tf.index] == 0 or tf.tfs.downloadStopped():
+                return False
+            header = min(16, tf.size - self.pos)
+            first, _ = tf.pieceFromOffset(self.pos)
+            last, _ = tf.pieceFromOffset(self.pos + header - 1)
+            missing = [p for p in range(first, last + 1) if not tf.tfs.havePiece(p)]
+            if missing:
+                for p in missing:
+                    if p not in self.requested:
+                        self.requested.add(p)
+                        tf.tfs.setPieceDeadline(p, 50, True)
+                tf.tfs.pieceDispatcher.register(missing[0], self)
+                return True
+            data = self.read(self.pos, header)
+            if len(data) < 8:
+                break
+            size, kind = struct.unpack('>I4s', data[:8])
+            if size == 1 and len(data) == 16:
+                size = struct.unpack('>Q', data[8:16])[0]
+            elif size == 0:
+                size = tf.size - self.pos
+            if size < 8:
+                break
+            if kind == 'moov':
+                tf.log('moov found at %d, %d bytes' % (self.pos, size))
+                tf.prefetchRange(self.pos, min(self.pos + size, tf.size))
+                break
+            self.pos += size
+            self.boxes += 1
+        self.done = True
+        return False
 
 #######################################################################################
 
+class PieceCache(object):
+    '''Общий для всех читателей TorrentFS кэш кусков в памяти.
+    Заполняется при первом чтении куска с диска или по read_piece_alert,
+    при превышении budget байт вытесняются давно не читанные куски (LRU).
+    Последние ответы read_piece хранятся отдельно, чтобы дождавшийся их читатель
+    получил кусок и при выключенном или маленьком кэше'''
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+        self.lock = threading.Lock()
+        self.pieces = collections.OrderedDict()
+        self.reading = dict()   # кусок -> когда перестать ждать вызванный для него read_piece
+        self.results = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    def enabled(self):
+        return self.budget > 0
+    def get(self, piece):
+        with self.lock:
+            data = self.pieces.pop(piece, None)
+            if data is None:
+                data = self.results.get(piece)
+                if data is not None:
+                    return data
+                self.misses += 1
+                return None
+            self.pieces[piece] = data
+            self.hits += 1
+            return data
+    def put(self, piece, data):
+        if len(data) > self.budget:
+            return
+        with self.lock:
+            old = self.pieces.pop(piece, None)
+            if old is not None:
+                self.size -= len(old)
+            self.pieces[piece] = data
+            self.size += len(data)
+            while self.size > self.budget:
+                _, evicted = self.pieces.popitem(last = False)
+                self.size -= len(evicted)
+    def discard(self, piece):
+        '''Забывает кусок, скачанный заново'''
+        with self.lock:
+            data = self.pieces.pop(piece, None)
+            if data is not None:
+                self.size -= len(data)
+            self.results.pop(piece, None)
+    def startRead(self, piece):
+        '''True, если read_piece для куска не вызван (или ответ на него так и не пришёл)
+        и его должен вызвать спросивший'''
+        now = time.time()
+        with self.lock:
+            if self.reading.get(piece, 0) > now:
+                return False
+            self.reading[piece] = now + READ_PIECE_TIMEOUT
+            return True
+    def finishRead(self, piece, data):
+        with self.lock:
+            self.reading.pop(piece, None)
+            if data is not None:
+                self.results.pop(piece, None)
+                self.results[piece] = data
+                while len(self.results) > READ_PIECE_RESULTS:
+                    self.results.popitem(last = False)
+        if data is not None:
+            self.put(piece, data)
+    def clear(self):
+        with self.lock:
+            self.pieces.clear()
+            self.results.clear()
+            self.reading.clear()
+            self.size = 0
+
+def checking(state):
+    '''Торрент проверяет файлы или resume data'''
+    return state in (state.queued_for_checking, state.checking_files, state.checking_resume_data)
+
+class PieceMap(object):
+    '''Упакованная битовая карта скачанных кусков, как bitfield протокола BitTorrent:
+    кусок 0 - старший бит первого байта. Обновляется по piece_finished_alert,
+    чтобы /pieces, ShowPieces и MemoryStorage не перебирали список status().pieces'''
+    def __init__(self, count):
+        self.count = count
+        self.bits = bytearray((count + 7) // 8)
+    def set(self, piece):
+        self.bits[piece >> 3] |= 0x80 >> (piece & 7)
+    def clear(self, piece):
+        self.bits[piece >> 3] &= ~(0x80 >> (piece & 7)) & 0xff
+    def load(self, pieces):
+        '''Перестраивает карту по списку torrent_status.pieces. True, если карта изменилась'''
+        if len(pieces) != self.count:
+            return False    # Статус запрошен без query_pieces
+        bits = bytearray(len(self.bits))
+        for i, have in enumerate(pieces):
+            if have:
+                bits[i >> 3] |= 0x80 >> (i & 7)
+        if bits == self.bits:
+            return False
+        self.bits = bits
+        return True
+    def value(self, first, count):
+        '''Биты кусков [first, first + count) как целое, кусок first - старший бит'''
+        if count <= 0:
+            return 0
+        value = int(binascii.hexlify(self.bits), 16)
+        return (value >> (len(self.bits) * 8 - first - count)) & ((1 << count) - 1)
+    def bitfield(self, first, count):
+        '''Упакованные биты кусков [first, first + count), выровненные на начало байта'''
+        if count <= 0:
+            return ''
+        pad = -count % 8
+        return binascii.unhexlify('%0*x' % ((count + pad) // 4, self.value(first, count) << pad))
+    def runs(self, first, count):
+        '''Серии скачанных кусков [[начало, длина], ...] внутри [first, first + count).
+        Байты 0x00 и 0xff обрабатываются регулярным выражением целыми сериями'''
+        runs = []
+        for m in PIECE_RUNS.finditer(self.bitfield(first, count)):
+            start = first + m.start() * 8
+            if m.group()[0] == '\xff':
+                chunks = ((0, (m.end() - m.start()) * 8),)
+            else:
+                chunks = BYTE_RUNS[ord(m.group())]
+            for bit, length in chunks:
+                if runs and runs[-1][0] + runs[-1][1] == start + bit:
+                    runs[-1][1] += length
+                else:
+                    runs.append([start + bit, length])
+        return runs
+    def missing(self, first, count, limit):
+        '''Первые limit нескачанных кусков внутри [first, first + count), по порядку'''
+        pieces = []
+        for m in MISSING_BYTES.finditer(self.bitfield(first, count)):
+            byte = ord(m.group())
+            start = first + m.start() * 8
+            for bit in range(min(8, first + count - start)):
+                if not byte & (0x80 >> bit):
+                    pieces.append(start + bit)
+                    if len(pieces) >= limit:
+                        return pieces
+        return pieces
+    def total(self, first = 0, count = None):
+        if count is None:
+            count = self.count
+        return bin(self.value(first, count)).count('1')
+
+class MemoryStorage(object):
+    '''Бюджет памяти --memory-storage. Файлы торрента лежат в RAM-файловой системе.
+    libtorrent не умеет забывать скачанный кусок: вырезанный из файла кусок он
+    продолжал бы раздавать пирам, а скачать его заново можно только проверкой
+    всего торрента. Поэтому куски не вытесняются, а budget - жёсткий предел:
+    когда скачанное его достигает, загрузка останавливается совсем (приоритеты
+    кусков 0, дедлайны сняты и новые не ставятся), и чтение нескачанного
+    завершается ошибкой. Состояние видно в /status как memory_storage_full'''
+    def __init__(self, tfs, budget):
+        self.tfs = tfs
+        self.budget = budget
+        self.full = False
+    def used(self):
+        tfs = self.tfs
+        if tfs.pieceMap is None:
+            return 0
+        return tfs.pieceMap.total() * tfs.info.piece_length()
+    def check(self):
+        '''Вызывается по каждому скачанному куску и из housekeeping'''
+        if self.full or self.used() < self.budget:
+            return
+        logging.warning('Memory storage budget of %d MiB is used up, downloading stopped',
+                        self.budget // (1024 * 1024))
+        self.tfs.stopDownload()
+
+#######################################################################################
+
+class FileMeta(object):
+    '''Неизменяемые сведения о файле торрента. Строятся один раз при получении метаданных'''
+    __slots__ = ('index', 'path', 'savePath', 'offset', 'size', 'mtime', 'startPiece', 'endPiece')
+    def __init__(self, index, fileEntry, savePath, pieceLength):
+        self.index = index
+        self.path = fileEntry.path
+        self.savePath = savePath
+        self.offset = fileEntry.offset
+        self.size = fileEntry.size
+        self.mtime = getattr(fileEntry, 'mtime', 0)
+        self.startPiece = int(self.offset // pieceLength)
+        self.endPiece = int((self.offset + max(self.size, 1) - 1) // pieceLength)
+
 class TorrentFile(object):
     tfs         =   None
     num         =   int()
     closed      =   True
-    savePath    =   str()
-    fileEntry   =   None
-    index       =   int()
+    meta        =   None
     filePtr     =   None
-    downloaded  =   int()
-    progress    =   float()
-    pdl_thread  =   None
-    def __init__(self, tfs, fileEntry, savePath, index):
+    cursorPiece =   None
+    waitEvent   =   None
+    position    =   0
+    lastBuffered =  None
+    seekPiece   =   None    # кусок пробной перемотки, пока окно не переехало
+    seekTime    =   0
+    probePiece  =   None
+    def __init__(self, tfs, meta):
         self.tfs = tfs
-        self.fileEntry = fileEntry
-        self.savePath = savePath
-        self.index = index
+        self.meta = meta
+        self.savePath = meta.savePath
+        self.index = meta.index
         self.piece_length = int(self.pieceLength())
         self.startPiece, self.endPiece = self.Pieces()
-        self.pieces_deadlined = [False for x in range(self.endPiece - self.startPiece)]
         self.offset = self.Offset()
         self.size = self.Size()
+        self.readAhead = ReadAhead(self, tfs.root.config.readaheadSeconds)
     def SavePath(self):
         return self.savePath
     def Index(self):
-        return tf.index
+        return self.index
     def Downloaded(self):
-        return self.downloaded
+        return self.tfs.getFileDownloadedBytes(self.index)
     def Progress(self):
-        return self.progress
+        return self.tfs.getFileProgress(self.index)
     def FilePtr(self):
         if self.closed:
             return None
         if self.filePtr is None:
-            #print('savePath: %s' % (self.savePath,))
-            while not os.path.exists(self.savePath):
-                time.sleep(0.1)
-            self.filePtr = io.open(self.savePath, 'rb')
+            # Вызывается только после того, как нужный кусок скачан, так что файл уже есть.
+            # Без буфера io: он мог бы закэшировать ещё не скачанные участки файла
+            self.filePtr = io.open(self.savePath, 'rb', buffering = 0)
         return self.filePtr
     def log(self, message):
         fnum = self.num
         logging.info("[%d] %s\n" % (fnum, message))
     def Pieces(self):
-        startPiece, _ = self.pieceFromOffset(1)
-        endPiece, _ = self.pieceFromOffset(self.Size() - 1)
-        return startPiece, endPiece
+        return self.meta.startPiece, self.meta.endPiece
     def SetPriority(self, priority):
         self.tfs.setPriority(self.index, priority)
     def Stat(self):
         return self
     def readOffset(self):
-        return self.filePtr.seek(0, io.SEEK_CUR)
+        return self.position
     def havePiece(self, piece):
-        return self.tfs.handle.have_piece(piece)
+        return self.tfs.havePiece(piece)
     def pieceLength(self):
         return self.tfs.info.piece_length()
     def pieceFromOffset(self, offset):
@@ -191,75 +1184,178 @@ class TorrentFile(object):
         pieceOffset = int((self.Offset() + offset) % self.piece_length)
         return piece, pieceOffset
     def Offset(self):
-        return self.fileEntry.offset
+        return self.meta.offset
+    def prefetchRange(self, start, end):
+        '''Дедлайны на куски байтового диапазона [start, end), по порядку от 50 мс'''
+        if start >= end:
+            return
+        first, _ = self.pieceFromOffset(start)
+        last, _ = self.pieceFromOffset(end - 1)
+        for i, p in enumerate(range(first, last + 1)):
+            if not self.tfs.havePiece(p):
+                self.tfs.setPieceDeadline(p, 50 + 20 * i, True)
+    def indexRanges(self):
+        '''Байтовые диапазоны начала и конца файла, которые плеер прочтёт до первого кадра'''
+        ext = os.path.splitext(self.SavePath())[1].lower()
+        head, tail = CONTAINER_PREFETCH.get(ext, (1, 0))
+        head = min(head, self.size)
+        return (0, head), (max(self.size - tail, head), self.size)
+    def prefetchIndex(self):
+        '''Заказывает начало и конец файла, которые плеер прочтёт до первого кадра.
+        Начало и конец получают одинаковые дедлайны и качаются параллельно,
+        так что проверка хвоста не ждёт упреждающей загрузки с начала'''
+        for start, end in self.indexRanges():
+            self.prefetchRange(start, end)
+        if os.path.splitext(self.SavePath())[1].lower() in MP4_EXTS:
+            self.tfs.indexLocator(self).start()
+    def bufferedPieces(self):
+        '''Сколько кусков подряд от курсора чтения уже скачано (не больше окна упреждения)'''
+        if self.cursorPiece is None:
+            return 0
+        limit = min(self.cursorPiece + 1 + self.readAhead.windowPieces(), self.endPiece + 1)
+        piece = self.cursorPiece
+        while piece < limit and self.havePiece(piece):
+            piece += 1
+        return piece - self.cursorPiece
+    def setCursor(self, piece):
+        '''Сообщает менеджеру дедлайнов, с какого куска теперь читаем'''
+        manager = self.tfs.deadlineManager
+        if self.seekPiece is not None:
+            if (0 <= (piece - self.seekPiece) * self.piece_length < SEEK_SETTLE_BYTES
+                    and time.time() - self.seekTime < SEEK_SETTLE_SECONDS):
+                if piece != self.probePiece:
+                    self.probePiece = piece
+                    manager.probe(self, piece)
+                return
+            # Читают с нового места всерьёз: окно переезжает сюда
+            self.seekPiece = None
+            self.cursorPiece = piece
+            manager.request(self, piece)
+            return
+        if piece != self.cursorPiece:
+            self.cursorPiece = piece
+            self.tfs.deadlineManager.request(self, piece)
     def waitForPiece(self, piece):
-        def set_deadlines(p):
-            next_piece = p + 1
-            BUF_SIZE = 20   # количество блоковв буфере
-            for i in range(BUF_SIZE):
-                if (next_piece + i < self.endPiece and 
-                    not self.pieces_deadlined[(next_piece + i)- self.startPiece] and not self.havePiece(next_piece + i)):
-                    self.tfs.handle.set_piece_deadline(next_piece + i, 70 + (20 * i))
-                    self.pieces_deadlined[next_piece + i] = True
-        if not self.havePiece(piece):
-            self.log('Waiting for piece %d' % (piece,))
-            self.tfs.handle.set_piece_deadline(piece, 50)
-        while not self.havePiece(piece):
-            if self.tfs.handle.piece_priority(piece) == 0 or self.closed:
-                return False
-            time.sleep(0.1)
-        if not isinstance(self.pdl_thread, threading.Thread) or not self.pdl_thread.is_alive():
-            self.pdl_thread = threading.Thread(target = set_deadlines, args = (piece,))
-            self.pdl_thread.start()
+        if self.havePiece(piece):
+            return True
+        self.log('Waiting for piece %d' % (piece,))
+        self.tfs.holdPiece(piece)
+        self.tfs.setPieceDeadline(piece, 50)
+        started = time.time()
+        try:
+            return self.waitForMissingPiece(piece)
+        finally:
+            self.tfs.root.metrics.observe('pyrrent2http_piece_wait_seconds', time.time() - started)
+    def waitForMissingPiece(self, piece):
+        timeout = self.tfs.root.config.pieceWaitTimeout
+        deadline = timeout > 0 and time.time() + timeout or None
+        while True:
+            # Регистрируемся до проверки have_piece, чтобы не потерять уведомление
+            event = self.tfs.pieceDispatcher.register(piece)
+            self.waitEvent = event
+            try:
+                if self.havePiece(piece):
+                    break
+                if self.tfs.handle.piece_priority(piece) == 0 or self.closed:
+                    return False
+                if deadline is not None and time.time() > deadline:
+                    self.log('Timed out waiting for piece %d' % (piece,))
+                    self.tfs.root.metrics.inc('pyrrent2http_piece_wait_timeouts_total')
+                    return False
+                self.tfs.holdPiece(piece)
+                event.wait()
+            finally:
+                self.waitEvent = None
+                self.tfs.pieceDispatcher.unregister(piece, event)
         return True
     def Close(self):
         if self.closed: return
         self.log('Closing %s...' % (self.Name(),))
         self.tfs.removeOpenedFile(self)
         self.closed = True
+        self.tfs.deadlineManager.release(self)
+        if self.waitEvent is not None:
+            self.waitEvent.set()
         if self.filePtr is not None:
             self.filePtr.close()
             self.filePtr = None
     def ShowPieces(self):
-        pieces = self.tfs.handle.status().pieces
-        str_ = ''
-        for i in range(self.startPiece, self.endPiece + 1):
-            if pieces[i] == False:
-                str_ += "-"
-            else:
-                str_ += "#"
-        self.log(str_)
-    def Read(self, buf):
-        filePtr = self.FilePtr()
-        if filePtr is None:
+        count = self.endPiece - self.startPiece + 1
+        bits = '{0:0{1}b}'.format(self.tfs.pieceMap.value(self.startPiece, count), count)
+        self.log(bits.replace('0', '-').replace('1', '#'))
+    def readAt(self, offset, length):
+        '''memoryview не больше length байт с offset, но не дальше конца куска,
+        из кэша кусков TorrentFS. Кусок уже должен быть скачан'''
+        piece, pieceOffset = self.pieceFromOffset(offset)
+        data = self.tfs.readPiece(piece, self)
+        if data is None:
+            raise IOError('Can not read piece %d' % (piece,))
+        length = min(length, len(data) - pieceOffset, self.size - offset)
+        return memoryview(data)[pieceOffset:pieceOffset + length]
+    def diskSafe(self, offset, length):
+        '''Сколько байт (не больше length) с offset можно отдать прямо с диска, в обход
+        libtorrent. Свежескачанные куски читаются через readAt(): он сверяет кусок
+        с хешем и при расхождении берёт его через read_piece'''
+        piece, pieceOffset = self.pieceFromOffset(offset)
+        safe = 0
+        while safe < length and piece <= self.endPiece and not self.tfs.freshPiece(piece):
+            safe += self.piece_length - (safe == 0 and pieceOffset or 0)
+            piece += 1
+        return min(safe, length)
+    def WaitForRange(self, offset, length, wait = True):
+        '''Ждёт кусок с offset и возвращает, сколько байт подряд
+        (не больше length) начиная с offset уже лежит на диске.
+        С wait=False не ждёт, а возвращает 0, если куска ещё нет'''
+        if self.closed:
+            raise IOError
+        self.readAhead.advance(offset)
+        piece, pieceOffset = self.pieceFromOffset(offset)
+        self.setCursor(piece)
+        self.position = offset
+        if not wait and not self.havePiece(piece):
+            self.tfs.holdPiece(piece)
+            self.tfs.setPieceDeadline(piece, 50)
+            return 0
+        if not self.waitForPiece(piece):
             raise IOError
-        toRead = len(buf)
-        if toRead > self.piece_length:
-            toRead = self.piece_length
-        readOffset = self.readOffset()
-        startPiece, _ = self.pieceFromOffset(readOffset)
-        endPiece, _ = self.pieceFromOffset(readOffset + toRead)
-        for i in range(startPiece,  endPiece + 1):
-            if not self.waitForPiece(i):
-                raise IOError
-        read = filePtr.readinto(buf)
-        return read
+        ready = self.piece_length - pieceOffset
+        piece += 1
+        while ready < length and piece <= self.endPiece and self.havePiece(piece):
+            ready += self.piece_length
+            piece += 1
+        ready = min(ready, length)
+        self.position = offset + ready     # Столько вызывающий сейчас отдаст
+        return ready
     def Seek(self, offset, whence):
-        filePtr = self.FilePtr()
-        if filePtr is None: return
+        if self.closed: return
         if whence == os.SEEK_END:
             #offset = self.Size() - offset
             offset = self.size - offset
-            whence = os.SEEK_SET
-        newOffset = filePtr.seek(offset, whence)
+        elif whence == os.SEEK_CUR:
+            offset += self.position
+        newOffset = self.position = max(offset, 0)
+        self.tfs.root.metrics.inc('pyrrent2http_seeks_total')
+        self.readAhead.reset(newOffset)
+        piece = self.pieceFromOffset(newOffset)[0]
+        manager = self.tfs.deadlineManager
+        if self.cursorPiece is None or manager.inWindow(self, piece):
+            probing = self.seekPiece is not None
+            self.seekPiece = None
+            if probing and piece == self.cursorPiece:
+                manager.request(self, piece)    # Снимает дедлайны пробы
+        else:
+            self.seekPiece = piece
+            self.seekTime = time.time()
+            self.probePiece = None
+        self.setCursor(piece)
         self.log('Seeking to %d/%d' % (newOffset, self.size))
         return newOffset
     def Name(self):
-        return self.fileEntry.path
+        return self.meta.path
     def Size(self):
-        return self.fileEntry.size
+        return self.meta.size
     def IsComplete(self):
-        return self.downloaded == self.size
+        return self.Downloaded() == self.size
 #######################################################################################
 
 class TorrentDir(object):
@@ -292,35 +1388,85 @@ class TorrentFS(object):
     shuttingDown   =    False
     fileCounter =       int()
     progresses  =       list()
+    fileMetas   =       list()
+    fileIndex   =       dict()
+    downloadRate =      int()
+    status      =       None
+    lastStatusInfo =    None
+    statusVersion =     0
+    progressVersion =   0
+    pieceMap    =       None
+    piecesVersion =     0
+    deadlinesVersion =  0
+    prefetchNext =      list()
+    resumeFile  =       ''
 
-    def __init__(self, root, handle, startIndex):
+    def __init__(self, root, handle, startIndex, savePath):
         self.root = root
         self.handle = handle
+        self.startIndex = startIndex
+        self.savePath = savePath
+        self.infoHash = str(handle.info_hash())
+        self.openedFiles = list()
+        self.priorities = list()
+        self.prioritiesLock = threading.RLock()     # priorities меняют и HTTP-потоки, и DeadlineManager
+        self.metadataReady = threading.Event()
+        self.pieceDispatcher = PieceDispatcher()
+        self.deadlineManager = DeadlineManager(self)
+        self.pieceCache = PieceCache(root.config.pieceCacheSize * 1024 * 1024)
+        self.versions = itertools.count(1)
+        self.deadlineDue = dict()   # кусок -> когда он должен был скачаться
+        self.pinnedPieces = set()   # куски индекса контейнера, их дедлайны не снимаются при перемотке
+        self.heldPieces = dict()    # кусок, которого ждёт читатель -> до какого времени держать его дедлайн
+        self.finishedAt = dict()    # кусок -> когда пришёл его piece_finished_alert
+        self.jsonCache = dict()     # ключ -> (версия, тело, ETag)
+        self.prefetchNext = list()  # индексы следующих за открытым файлов для --prefetch-next
+        self.prefetchRequested = set()  # индексы файлов, запрошенных через /prefetch
+        self.prefetchApplied = set()    # индексы файлов, кускам которых уже поставлен PREFETCH_PRIORITY
+        self.indexLocators = dict()     # индекс файла -> Mp4IndexLocator
+        self.memoryStorage = None
+        if root.config.memoryStorage:
+            self.memoryStorage = MemoryStorage(self, root.config.memoryStorageSize * 1024 * 1024)
         self.waitForMetadata()
+
+    def onMetadata(self):
+        '''Вызывается, как только у торрента появились метаданные'''
+        self.buildFileIndex()
+        self.pieceMap = PieceMap(self.info.num_pieces())
+        self.pieceMap.load(self.handle.status().pieces)
+        self.piecesVersion = next(self.versions)
         self.priorities = [[i, p] for i,p in enumerate(self.handle.file_priorities())]
-        if startIndex < 0:
+        if self.startIndex < 0:
             logging.info('No -file-index specified, downloading will be paused until any file is requested')
-        for i in range(self.TorrentInfo().num_files()):
-            if startIndex == i:
-                self.setPriority(i, 1)
+        for i in range(self.info.num_files()):
+            if self.startIndex == i:
+                self.setPriority(i, FILE_PRIORITY)
             else:
                 self.setPriority(i, 0)
+        self.metadataReady.set()
 
     def Shutdown(self):
         self.shuttingDown = True
         if len(self.openedFiles) > 0:
             logging.info('Closing %d opened file(s)' % (len(self.openedFiles),))
-            for f in self.openedFiles:
+            for f in list(self.openedFiles):
                 f.Close()
+        self.deadlineManager.stop()
+        for locator in self.indexLocators.values():
+            locator.set()   # Поток локатора увидит shuttingDown и завершится
+        self.pieceCache.clear()
     def LastOpenedFile(self):
         return self.lastOpenedFile  
     def addOpenedFile(self, file_):
         self.openedFiles.append(file_)    
     def setPriority(self, index, priority):
-        if self.priorities[index] != priority:
-            logging.info('Setting %s priority to %d', self.info.file_at(index).path, priority)
-            self.priorities[index] = priority
-            self.handle.file_priority(index, priority)
+        with self.prioritiesLock:
+            if self.priorities[index] != priority:
+                logging.info('Setting %s priority to %d', self.info.file_at(index).path, priority)
+                self.priorities[index] = priority
+                self.prefetchApplied.discard(index)     # file_priority() сбросит приоритеты его кусков
+                if self.memoryStorage is None or not self.memoryStorage.full:
+                    self.handle.file_priority(index, priority)
     def findOpenedFile(self, file):
         for i, f in enumerate(self.openedFiles):
             if f == file:
@@ -331,89 +1477,349 @@ class TorrentFS(object):
         if pos >= 0:
             del self.openedFiles[pos]
     def waitForMetadata(self):
-        if not self.handle.status().has_metadata:
-            time.sleep(0.1)
+        '''Не блокирует: для магнитов без метаданных onMetadata() вызовется
+        позже, по metadata_received_alert'''
+        if self.info is not None or not self.handle.status().has_metadata:
+            return
         try:
-            self.info = self.handle.torrent_file()
+            info = self.handle.torrent_file()
         except:
-            self.info = self.handle.get_torrent_info()
+            info = self.handle.get_torrent_info()
+        if info is None:
+            return
+        self.info = info
+        self.onMetadata()
+    def Name(self):
+        if self.info is not None:
+            return self.info.name()
+        return self.handle.status().name
+    def buildFileIndex(self):
+        info = self.info
+        pieceLength = info.piece_length()
+        savePath = self.SavePath()
+        self.fileMetas = [FileMeta(i, info.file_at(i), os.path.abspath(os.path.join(savePath, info.file_at(i).path)), pieceLength)
+                          for i in range(info.num_files())]
+        self.fileIndex = dict((self.normalizePath(meta.savePath), meta.index) for meta in self.fileMetas)
+    def normalizePath(self, path):
+        return os.path.normcase(os.path.abspath(path))
     def HasTorrentInfo(self):
         return self.info is not None
     def TorrentInfo(self):
-        while not isinstance(self.info, lt.torrent_info):
-            time.sleep(0.1)
+        self.metadataReady.wait()
         return self.info
     def LoadFileProgress(self):
-        self.progresses = self.handle.file_progress()
+        progresses = self.handle.file_progress()
+        if progresses != self.progresses:
+            old = self.progresses
+            self.progresses = progresses
+            self.progressVersion = next(self.versions)
+            changed = [i for i, bytes in enumerate(progresses) if i >= len(old) or old[i] != bytes]
+            self.root.events.publish('files', {'info_hash': self.infoHash, 'files': [
+                {'index': i, 'download': progresses[i], 'progress': self.getFileProgress(i)} for i in changed]})
+    def publishBuffers(self):
+        '''Событие buffer для открытых файлов, у которых изменился запас кусков перед курсором'''
+        for f in list(self.openedFiles):
+            buffered = (f.cursorPiece, f.bufferedPieces())
+            if f.cursorPiece is None or buffered == f.lastBuffered:
+                continue
+            f.lastBuffered = buffered
+            self.root.events.publish('buffer', {'info_hash': self.infoHash, 'index': f.index, 'name': f.Name(),
+                                                'cursor_piece': buffered[0], 'buffered_pieces': buffered[1],
+                                                'buffered_bytes': buffered[1] * f.piece_length})
+    def Status(self):
+        '''Последний снимок torrent_status, обновляемый главным циклом по state_update_alert'''
+        if self.status is None:
+            self.updateStatus(self.handle.status())
+        return self.status
+    def updateStatus(self, status):
+        # Куски, найденные проверкой файлов и resume data, приходят без piece_finished_alert
+        if self.pieceMap is not None and (checking(status.state) or self.status is None or checking(self.status.state)):
+            if self.pieceMap.load(status.pieces):
+                self.piecesVersion = next(self.versions)
+        self.status = status
+        self.downloadRate = status.download_rate
+        self.statusVersion = next(self.versions)
+        info = self.StatusInfo()
+        last = self.lastStatusInfo
+        self.lastStatusInfo = info
+        changed = dict((k, v) for k, v in info.items() if last is None or last.get(k) != v)
+        if changed:
+            changed['info_hash'] = self.infoHash
+            self.root.events.publish('status', changed)
+    def StatusInfo(self):
+        tstatus = self.Status()
+        return {
+                     'name'           :   self.Name(),
+                     'state'          :   int(tstatus.state),
+                     'state_str'       :   str(tstatus.state),
+                     'error'          :   tstatus.error,
+                     'progress'       :   tstatus.progress,
+                     'download_rate'   :   tstatus.download_rate / 1024,
+                     'upload_rate'     :   tstatus.upload_rate / 1024,
+                     'total_download'  :   tstatus.total_download,
+                     'total_upload'    :   tstatus.total_upload,
+                     'num_peers'       :   tstatus.num_peers,
+                     'num_seeds'       :   tstatus.num_seeds,
+                     'total_seeds'     :   tstatus.num_complete,
+                     'total_peers'     :   tstatus.num_incomplete,
+                     'memory_storage_full': self.downloadStopped()
+                     }
+    def cachedJSON(self, key, version, build):
+        '''(тело, ETag) JSON-ответа, который пересобирается, только когда меняется version.
+        Стоимость опроса не зависит от числа клиентов'''
+        return self.cachedBody(key, version, lambda: json.dumps(build()))
+    def cachedBody(self, key, version, build):
+        cached = self.jsonCache.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1], cached[2]
+        body = build()
+        etag = '"%08x"' % (zlib.crc32(body) & 0xffffffff,)
+        self.jsonCache[key] = (version, body, etag)
+        return body, etag
     def getFileDownloadedBytes(self, i):
         try:
             bytes = self.progresses[i]
         except IndexError:
             bytes = 0
         return bytes
+    def setPieceDeadline(self, piece, ms, pinned = False):
+        if self.memoryStorage is not None and self.memoryStorage.full:
+            return  # Бюджет памяти исчерпан, новые куски не качаются
+        if pinned:
+            self.pinnedPieces.add(piece)
+        self.handle.set_piece_deadline(piece, ms)
+        self.deadlineDue[piece] = time.time() + ms / 1000.0
+        self.deadlinesVersion = next(self.versions)
+        self.root.metrics.inc('pyrrent2http_piece_deadlines_total')
+    def resetPieceDeadline(self, piece):
+        self.handle.reset_piece_deadline(piece)
+        self.deadlineDue.pop(piece, None)
+        self.deadlinesVersion = next(self.versions)
+    def onPieceFinished(self, piece):
+        due = self.deadlineDue.pop(piece, None)
+        self.pinnedPieces.discard(piece)
+        self.heldPieces.pop(piece, None)
+        self.finishedAt[piece] = time.time()
+        if due is not None and time.time() > due:
+            self.root.metrics.inc('pyrrent2http_piece_deadlines_missed_total')
+        if self.pieceMap is not None:
+            self.pieceMap.set(piece)
+            self.piecesVersion = next(self.versions)
+        if self.memoryStorage is not None:
+            self.memoryStorage.check()
+        self.pieceCache.discard(piece)
+        self.pieceDispatcher.notify(piece)
+    def havePiece(self, piece):
+        return self.handle.have_piece(piece)
+    def freshPiece(self, piece):
+        '''Кусок скачан только что: на диске могут быть ещё старые данные'''
+        return time.time() - self.finishedAt.get(piece, 0) < PIECE_FLUSH_GRACE
+    def holdPiece(self, piece):
+        '''Читатель ждёт кусок: его дедлайн не снимается, пока ожидание не прекратится
+        (поток ожидания продлевает срок при каждом пробуждении) или кусок не скачается'''
+        self.heldPieces[piece] = time.time() + PIECE_WAIT_HOLD
+    def downloadStopped(self):
+        return self.memoryStorage is not None and self.memoryStorage.full
+    def stopDownload(self):
+        '''Останавливает загрузку кусков, когда исчерпан бюджет --memory-storage.
+        Ждущие читатели просыпаются и получают ошибку: их кусок уже не скачается'''
+        handle = self.handle
+        with self.prioritiesLock:
+            self.memoryStorage.full = True
+            self.prefetchApplied.clear()
+            handle.prioritize_pieces([0] * self.info.num_pieces())
+            for piece in list(self.deadlineDue):
+                handle.reset_piece_deadline(piece)
+            self.deadlineDue.clear()
+            self.pinnedPieces.clear()
+            self.heldPieces.clear()
+            self.deadlinesVersion = next(self.versions)
+        self.pieceDispatcher.wakeAll()
+    def readPiece(self, piece, tf):
+        '''Содержимое скачанного куска из кэша. Кусок целиком внутри файла tf
+        читается с диска, кусок на стыке файлов - через read_piece'''
+        data = self.pieceCache.get(piece)
+        if data is not None:
+            return data
+        started = time.time()
+        data = self.loadPiece(piece, tf)
+        self.root.metrics.observe('pyrrent2http_piece_read_seconds', time.time() - started)
+        return data
+    def loadPiece(self, piece, tf):
+        cache = self.pieceCache
+        pieceLength = self.info.piece_length()
+        start = piece * pieceLength
+        end = min(start + pieceLength, self.info.total_size())
+        if tf.offset <= start and end <= tf.offset + tf.size:
+            filePtr = tf.FilePtr()
+            if filePtr is None:
+                return None
+            filePtr.seek(start - tf.offset)
+            data = filePtr.read(end - start)
+            if len(data) != end - start:
+                raise IOError('Unexpected end of %s' % (tf.SavePath(),))
+            # Сразу после piece_finished_alert кусок может быть ещё в кэше записи libtorrent,
+            # а на диске - старые данные. В кэш попадает только кусок, сошедшийся с хешем,
+            # иначе он читается через read_piece, который видит и кэш записи
+            if hashlib.sha1(data).digest() == self.info.hash_for_piece(piece):
+                cache.put(piece, data)
+                return data
+        attempts = 0
+        deadline = time.time() + 2 * READ_PIECE_TIMEOUT
+        while True:
+            event = self.pieceDispatcher.register(piece)
+            try:
+                data = cache.get(piece)
+                if data is not None:
+                    return data
+                if tf.closed or self.shuttingDown or not self.handle.have_piece(piece):
+                    return None
+                if time.time() >= deadline:
+                    logging.warning('Timed out reading piece %d', piece)
+                    return None
+                if cache.startRead(piece):
+                    if attempts == 2:
+                        return None
+                    attempts += 1
+                    self.handle.read_piece(piece)
+                event.wait(max(deadline - time.time(), 0))
+            finally:
+                self.pieceDispatcher.unregister(piece, event)
+    def getFileProgress(self, i):
+        size = self.fileMetas[i].size
+        if size <= 0:
+            return 0.0
+        return float(self.getFileDownloadedBytes(i))/float(size)
     def Files(self):
-        info = self.TorrentInfo()
-        files = [None for x in range(info.num_files())]
-        for i in range(info.num_files()):
-            file_ = self.FileAt(i)
-            file_.downloaded = self.getFileDownloadedBytes(i)
-            if file_.Size() > 0:
-                file_.progress = float(file_.downloaded)/float(file_.Size())
-            files[i] = file_
-        return files
+        '''Сведения о всех файлах торрента, без открытия TorrentFile'''
+        self.TorrentInfo()
+        return self.fileMetas
     def SavePath(self):
-        return self.root.torrentParams['save_path']
+        return self.savePath
     def FileAt(self, index):
-        info = self.TorrentInfo()
-        if index < 0 or index >= info.num_files():
+        self.TorrentInfo()
+        if index < 0 or index >= len(self.fileMetas):
             raise IndexError
-        fileEntry = info.file_at(index)
-        path = os.path.abspath(os.path.join(self.SavePath(), fileEntry.path))
-        return TorrentFile(
-                           self,
-                           fileEntry,
-                           path,
-                           index
-                           )
+        return TorrentFile(self, self.fileMetas[index])
+    def FileMetaByName(self, name):
+        index = self.fileIndex.get(self.normalizePath(os.path.join(self.SavePath(), name)))
+        if index is None:
+            return None
+        return self.fileMetas[index]
     def FileByName(self, name):
-        savePath = os.path.abspath(os.path.join(self.SavePath(), name))
-        for file_ in self.Files():
-            if file_.SavePath() == savePath:
-                return file_
-        raise IOError
+        meta = self.FileMetaByName(name)
+        if meta is None:
+            raise IOError
+        return self.FileAt(meta.index)
     def Open(self, name):
         if self.shuttingDown or not self.HasTorrentInfo():
             raise IOError
         if name == '/':
             return TorrentDir(self)
         return self.OpenFile(name)
+    def activeReaders(self):
+        '''Открытые файлы, из которых уже читают'''
+        return [f for f in list(self.openedFiles) if f.cursorPiece is not None]
     def checkPriorities(self):
-        for index, priority in enumerate(self.priorities):
-            if priority == 0:
-                continue
-            found = False
-            for f in self.openedFiles:
-                if f.index == index:
-                    found = True
-                    break
-            if not found:
-                self.setPriority(index, 0)
+        with self.prioritiesLock:
+            for index, priority in enumerate(self.priorities):
+                if priority == 0:
+                    continue
+                found = False
+                for f in self.openedFiles:
+                    if f.index == index:
+                        found = True
+                        break
+                if not found:
+                    self.setPriority(index, 0)
     def OpenFile(self, name):
-        try:
-            tf = self.FileByName(name)
-        except IOError:
-            return
+        tf = self.FileByName(name)
         tf.closed = False
         self.fileCounter += 1
         tf.num = self.fileCounter
         tf.log('Opening %s...' % (tf.Name(),))
-        tf.SetPriority(1)
-        startPiece, _ = tf.Pieces()
-        self.handle.set_piece_deadline(startPiece, 50)
+        tf.SetPriority(FILE_PRIORITY)
+        tf.prefetchIndex()
         self.lastOpenedFile = tf
         self.addOpenedFile(tf)
         self.checkPriorities()
+        self.prefetchRequested.discard(tf.index)
+        self.findNextFiles(tf.meta)
+        self.applyPrefetch()
         return tf
+    def findNextFiles(self, meta):
+        '''--prefetch-next: следующие за meta файлы торрента; после видео - только видео'''
+        count = self.root.config.prefetchNext
+        if count <= 0 or self.memoryStorage is not None:
+            return
+        video = os.path.splitext(meta.path)[1].lower() in VIDEO_EXTS
+        self.prefetchNext = [m.index for m in self.fileMetas[meta.index + 1:]
+                             if not video or os.path.splitext(m.path)[1].lower() in VIDEO_EXTS][:count]
+    def indexLocator(self, tf):
+        '''Один Mp4IndexLocator на файл, сколько бы раз плеер его ни открывал'''
+        locator = self.indexLocators.get(tf.index)
+        if locator is None:
+            locator = self.indexLocators.setdefault(tf.index, Mp4IndexLocator(tf))
+        return locator
+    def Prefetch(self, meta):
+        '''Заказывает начало и индекс файла meta (/prefetch), возвращает число нескачанных кусков'''
+        self.prefetchRequested.add(meta.index)
+        return self.applyPrefetch(meta.index)
+    def prefetchPieces(self, meta):
+        '''Полуинтервалы кусков, которые плеер прочтёт первыми: --prefetch-size с начала и индекс в конце'''
+        _, tail = CONTAINER_PREFETCH.get(os.path.splitext(meta.path)[1].lower(), (1, 0))
+        head = min(self.root.config.prefetchSize * 1024 * 1024, meta.size)
+        pieceLength = self.info.piece_length()
+        ranges = list()
+        for start, end in ((0, head), (max(meta.size - tail, head), meta.size)):
+            if start < end:
+                ranges.append(((meta.offset + start) // pieceLength, (meta.offset + end - 1) // pieceLength + 1))
+        return ranges
+    def applyPrefetch(self, only = None):
+        '''PREFETCH_PRIORITY (ниже, чем у открытых файлов) кускам начала и индекса заказанных,
+        но не открытых файлов. Ставится один раз на файл; setPriority() сбрасывает приоритеты
+        кусков файла и убирает его из prefetchApplied, тогда его подхватит housekeeping.
+        Возвращает число нескачанных кусков (для /prefetch - одного файла only)'''
+        if self.pieceMap is None:
+            return 0
+        handle = self.handle
+        missing = 0
+        with self.prioritiesLock:
+            targets = set(self.prefetchNext) | self.prefetchRequested
+            self.dropPrefetch(self.prefetchApplied - targets, targets)
+            for index in targets:
+                if only is not None and index != only:
+                    continue
+                if self.priorities[index] > 0:
+                    continue    # Файл открыт, его куски и так качаются
+                if index in self.prefetchApplied and only is None:
+                    continue
+                for first, end in self.prefetchPieces(self.fileMetas[index]):
+                    for p in self.pieceMap.missing(first, end - first, end - first):
+                        missing += 1
+                        if not self.downloadStopped() and handle.piece_priority(p) == 0:
+                            handle.piece_priority(p, PREFETCH_PRIORITY)
+                self.prefetchApplied.add(index)
+        return missing
+    def prefetchPieceSet(self, index):
+        return set(p for first, end in self.prefetchPieces(self.fileMetas[index]) for p in xrange(first, end))
+    def dropPrefetch(self, indexes, targets):
+        '''Возвращает кускам файлов, которые больше не заказаны (открыт другой файл), приоритет
+        их файла. Куски, общие с оставшимися целями, и куски с дедлайнами не трогаем'''
+        if not indexes:
+            return
+        handle = self.handle
+        keep = set()
+        for index in targets:
+            keep.update(self.prefetchPieceSet(index))
+        for index in indexes:
+            self.prefetchApplied.discard(index)
+            priority = not self.downloadStopped() and self.priorities[index] or 0
+            for p in self.prefetchPieceSet(index) - keep:
+                if p in self.deadlineDue or self.havePiece(p):
+                    continue
+                if handle.piece_priority(p) == PREFETCH_PRIORITY:
+                    handle.piece_priority(p, priority)
         
 #############################################################
 
@@ -432,154 +1838,869 @@ class BoolArg(argparse.Action):
         setattr(namespace, self.dest, v)
         
 class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True   # Простаивающие keep-alive соединения не держат выход
     def handle_error(self, *args, **kwargs):
         '''Обходим злосчастный "Broken Pipe" и прочие трейсы'''
         if not AVOID_HTTP_SERVER_EXCEPTION_OUTPUT:
             BaseHTTPServer.HTTPServer.handle_error(self, *args, **kwargs)
 
+def socketPair():
+    if hasattr(socket, 'socketpair'):
+        return socket.socketpair()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    client = socket.create_connection(listener.getsockname())
+    server, _ = listener.accept()
+    listener.close()
+    return server, client
+
+class Executor(object):
+    '''Небольшой пул потоков для блокирующих вызовов libtorrent и диска'''
+    def __init__(self, workers):
+        self.queue = Queue.Queue()
+        for i in range(workers):
+            thread = threading.Thread(target = self.run)
+            thread.daemon = True
+            thread.start()
+    def submit(self, func, *args):
+        self.queue.put((func, args))
+    def run(self):
+        while True:
+            func, args = self.queue.get()
+            try:
+                func(*args)
+            except Exception:
+                if not AVOID_HTTP_SERVER_EXCEPTION_OUTPUT:
+                    logging.exception('Executor job failed')
+
+class Waker(asyncore.dispatcher):
+    '''Будит цикл asyncore из других потоков и выполняет в нём отложенные вызовы'''
+    def __init__(self, map):
+        self.reader, self.writer = socketPair()
+        asyncore.dispatcher.__init__(self, self.reader, map = map)
+        self.lock = threading.Lock()
+        self.calls = collections.deque()
+    def callSoon(self, func, *args):
+        with self.lock:
+            self.calls.append((func, args))
+            wake = len(self.calls) == 1
+        if wake:
+            try:
+                self.writer.send('x')
+            except socket.error:
+                pass
+    def writable(self):
+        return False
+    def handle_read(self):
+        try:
+            self.recv(4096)
+        except socket.error:
+            pass
+        with self.lock:
+            calls = self.calls
+            self.calls = collections.deque()
+        for func, args in calls:
+            func(*args)
+    def handle_close(self):
+        pass
+    def close(self):
+        asyncore.dispatcher.close(self)
+        self.writer.close()
+
+class PieceCallback(object):
+    '''Ожидание куска для PieceDispatcher: вместо Event вызывает функцию в цикле asyncore'''
+    def __init__(self, server, func, *args):
+        self.server = server
+        self.func = func
+        self.args = args
+    def set(self):
+        self.server.callSoon(self.func, *self.args)
+
+class FileStream(object):
+    '''Тело ответа /files/ для AsyncHTTPServer. Следующий кусок данных читается
+    в пуле потоков, только когда в буфере соединения освободилось место.
+    body - части тела: строки (разделители multipart) и диапазоны файла (start, end)'''
+    CHUNK = 256 * 1024
+    def __init__(self, conn, f, body):
+        self.conn = conn
+        self.f = f
+        self.parts = collections.deque(body)
+        self.offset = 0
+        self.end = 0
+        self.busy = False
+        self.waitStart = None
+        self.readStart = None   # когда начато чтение очередной порции, с ожиданием кусков
+        self.waiter = None      # (кусок, PieceCallback), пока ждём кусок
+        self.signaled = None    # PieceCallback, сработавший раньше, чем мы начали ждать
+        self.nextPart()
+    def nextPart(self):
+        while self.offset >= self.end and self.parts:
+            part = self.parts.popleft()
+            if isinstance(part, tuple):
+                self.offset, self.end = part
+                self.f.Seek(self.offset, os.SEEK_SET)
+            else:
+                self.conn.push(part)
+    def done(self):
+        return self.offset >= self.end and not self.parts
+    def pump(self):
+        if self.busy or self.done() or self.conn.outSize >= AsyncHTTPConnection.HIGH_WATER:
+            return
+        self.busy = True
+        self.conn.server.executor.submit(self.read)
+    def read(self):
+        f = self.f
+        if self.readStart is None:
+            self.readStart = time.time()
+        piece, _ = f.pieceFromOffset(self.offset)
+        waiter = PieceCallback(self.conn.server, self.resume)
+        waiter.args = (waiter,)
+        # Подписываемся до проверки have_piece, чтобы не потерять уведомление
+        f.tfs.pieceDispatcher.register(piece, waiter)
+        try:
+            length = f.WaitForRange(self.offset, min(self.end - self.offset, self.CHUNK), False)
+            if length == 0:
+                if f.closed or f.tfs.handle.piece_priority(piece) == 0:
+                    raise IOError
+                timeout = f.tfs.root.config.pieceWaitTimeout
+                if self.waitStart is None:
+                    self.waitStart = time.time()
+                    f.log('Waiting for piece %d' % (piece,))
+                elif timeout > 0 and time.time() - self.waitStart > timeout:
+                    f.log('Timed out waiting for piece %d' % (piece,))
+                    f.tfs.root.metrics.inc('pyrrent2http_piece_wait_timeouts_total')
+                    raise IOError
+                self.conn.server.callSoon(self.park, piece, waiter)
+                return
+            f.tfs.pieceDispatcher.unregister(piece, waiter)
+            if self.waitStart is not None:
+                f.tfs.root.metrics.observe('pyrrent2http_piece_wait_seconds', time.time() - self.waitStart)
+            self.waitStart = None
+            safe = not f.tfs.pieceCache.enabled() and f.diskSafe(self.offset, length) or 0
+            if safe == 0:
+                # Кэш кусков или свежескачанный кусок
+                chunks = list()
+                read = 0
+                while read < length:
+                    chunk = f.readAt(self.offset + read, length - read)
+                    chunks.append(chunk)
+                    read += len(chunk)
+            else:
+                length = safe
+                filePtr = f.FilePtr()
+                filePtr.seek(self.offset)
+                data = bytearray(length)
+                view = memoryview(data)
+                read = 0
+                while read < length:
+                    n = filePtr.readinto(view[read:])
+                    if not n:
+                        raise IOError('Unexpected end of %s' % (f.SavePath(),))
+                    read += n
+                chunks = [data]
+        except Exception:
+            f.tfs.pieceDispatcher.unregister(piece, waiter)
+            self.conn.server.callSoon(self.conn.abort)
+            return
+        metrics = f.tfs.root.metrics
+        metrics.observe('pyrrent2http_read_seconds', time.time() - self.readStart)
+        metrics.inc('pyrrent2http_read_bytes_total', length)
+        self.readStart = None
+        self.conn.server.callSoon(self.deliver, chunks)
+    def deliver(self, chunks):
+        self.busy = False
+        size = 0
+        for data in chunks:
+            size += len(data)
+            self.conn.push(data)
+        self.offset += size
+        self.f.tfs.root.metrics.inc('pyrrent2http_http_bytes_total', size, file = self.f.Name(), info_hash = self.f.tfs.infoHash)
+        self.nextPart()
+        if self.done():
+            self.conn.finishResponse()
+        else:
+            self.pump()
+    def park(self, piece, waiter):
+        if self.signaled is waiter:
+            self.busy = False
+            self.pump()
+        else:
+            self.waiter = (piece, waiter)
+    def resume(self, waiter):
+        # park() и resume() выполняются в цикле asyncore в порядке вызова callSoon
+        if self.waiter is None or self.waiter[1] is not waiter:
+            self.signaled = waiter
+            return
+        self.waiter = None
+        self.busy = False
+        self.pump()
+    def close(self):
+        if self.waiter is not None:
+            self.f.tfs.pieceDispatcher.unregister(*self.waiter)
+            self.waiter = None
+
+class EventStream(object):
+    '''Тело ответа /events для AsyncHTTPServer: поток SSE (sse=True)
+    или один ответ long-poll, отправляемый при первом событии или пинге'''
+    def __init__(self, conn, bus, since, infoHash, sse):
+        self.conn = conn
+        self.bus = bus
+        self.since = since
+        self.infoHash = infoHash
+        self.sse = sse
+        self.seen = since   # последний номер в журнале на момент прошлой проверки
+        self.finished = False
+        self.closed = False
+        self.listener = PieceCallback(conn.server, self.wakeup)
+        bus.subscribe(self.listener)
+    def done(self):
+        return self.finished
+    def pump(self):
+        events, seq = self.bus.since(self.since, self.infoHash)
+        self.seen = seq
+        if not events:
+            return
+        self.since = seq
+        if self.sse:
+            self.conn.push(formatEvents(events))
+        else:
+            self.respond(events, seq)
+    def wakeup(self):
+        if self.closed:
+            return
+        seen = self.seen
+        events, seq = self.bus.since(self.since, self.infoHash)
+        if events:
+            self.pump()
+            return
+        self.seen = seq
+        if seq != seen:
+            return      # События других торрентов
+        # Разбудил keepAlive
+        if self.sse:
+            self.conn.push(': keep-alive\n\n')
+        else:
+            self.respond(events, seq)
+    def respond(self, events, seq):
+        if self.finished:
+            return
+        self.finished = True
+        self.conn.push(json.dumps({'seq': seq, 'events': jsonEvents(events)}))
+        self.conn.finishResponse()
+    def close(self):
+        self.closed = True
+        self.bus.unsubscribe(self.listener)
+
+class AsyncHTTPConnection(asyncore.dispatcher):
+    '''Одно соединение AsyncHTTPServer. Запросы выполняются обычным HttpHandler
+    в пуле потоков, ответ копится в буфере и отдаётся по мере готовности сокета'''
+    HIGH_WATER = 512 * 1024
+    MAX_REQUEST = 64 * 1024
+    def __init__(self, sock, addr, server):
+        asyncore.dispatcher.__init__(self, sock, map = server.map)
+        self.server = server
+        self.addr = addr
+        self.inbuf = ''
+        self.outbuf = collections.deque()
+        self.outSize = 0
+        self.busy = False
+        self.stream = None
+        self.closeWhenDone = False
+        self.openFile = None    # (TorrentFile, ключ) для следующего запроса в этом соединении
+    def readable(self):
+        return not self.closeWhenDone and len(self.inbuf) < self.MAX_REQUEST
+    def writable(self):
+        return self.outSize > 0
+    def handle_read(self):
+        data = self.recv(65536)
+        if not data:
+            return
+        self.inbuf += data
+        self.nextRequest()
+    def nextRequest(self):
+        if self.busy or self.closeWhenDone:
+            return
+        end = self.inbuf.find('\r\n\r\n')
+        if end < 0:
+            if len(self.inbuf) >= self.MAX_REQUEST:
+                self.close()
+            return
+        request = self.inbuf[:end + 4]
+        self.inbuf = self.inbuf[end + 4:]
+        self.busy = True
+        openFile, self.openFile = self.openFile, None   # вернётся в startResponse
+        self.server.executor.submit(self.handleRequest, request, openFile)
+    def handleRequest(self, request, openFile):
+        '''Выполняется в пуле потоков'''
+        handler = self.server.BufferedHandlerClass((request, openFile), self.addr, self.server)
+        openFile = handler.openFile is not None and (handler.openFile, handler.openFileKey) or None
+        self.server.callSoon(self.startResponse, handler.wfile.getvalue(), handler.stream, handler.close_connection, openFile)
+    def startResponse(self, head, stream, closeConnection, openFile):
+        self.openFile = openFile
+        if not self.connected:
+            self.closeOpenFile()
+            return
+        self.closeWhenDone = bool(closeConnection)
+        self.push(head)
+        if stream is not None:
+            self.stream = stream(self)
+            if not self.stream.done():
+                self.stream.pump()
+                return
+        self.finishResponse()
+    def finishResponse(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        self.busy = False
+        if not self.closeWhenDone:
+            self.nextRequest()
+        elif self.outSize == 0:
+            self.close()
+    def abort(self):
+        self.closeWhenDone = True
+        self.close()
+    def push(self, data):
+        if data:
+            self.outbuf.append(data)
+            self.outSize += len(data)
+    def handle_write(self):
+        while self.outbuf:
+            data = self.outbuf[0]
+            sent = self.send(data)
+            self.outSize -= sent
+            if sent < len(data):
+                self.outbuf[0] = memoryview(data)[sent:]
+                break
+            self.outbuf.popleft()
+        if self.stream is not None:
+            self.stream.pump()
+        elif self.outSize == 0 and self.closeWhenDone and not self.busy:
+            self.close()
+    def handle_close(self):
+        self.close()
+    def handle_error(self):
+        if not AVOID_HTTP_SERVER_EXCEPTION_OUTPUT:
+            asyncore.dispatcher.handle_error(self)
+        self.close()
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        self.outbuf.clear()
+        self.outSize = 0
+        self.closeOpenFile()
+        asyncore.dispatcher.close(self)
+    def closeOpenFile(self):
+        if self.openFile is not None:
+            self.openFile[0].Close()
+            self.openFile = None
+
+class AsyncHTTPServer(asyncore.dispatcher):
+    '''Однопоточный HTTP-сервер на asyncore (в Python 2 нет asyncio).
+    Соединения не занимают потоков, пока ждут кусков или сокета;
+    блокирующие вызовы выполняются в пуле из workers потоков'''
+    def __init__(self, address, RequestHandlerClass, workers):
+        self.map = dict()
+        asyncore.dispatcher.__init__(self, map = self.map)
+        self.RequestHandlerClass = RequestHandlerClass
+        class BufferedHandler(RequestHandlerClass):
+            '''Обрабатывает один запрос из строки в буфер вместо сокета'''
+            deferStreaming = True
+            def setup(self):
+                data, openFile = self.request
+                if openFile is not None:
+                    self.openFile, self.openFileKey = openFile
+                self.connection = None
+                self.rfile = cStringIO.StringIO(data)
+                self.wfile = cStringIO.StringIO()
+            def handle(self):
+                self.close_connection = 1
+                try:
+                    self.handle_one_request()
+                except Exception:
+                    self.close_connection = 1
+                    if not AVOID_HTTP_SERVER_EXCEPTION_OUTPUT:
+                        logging.exception('HTTP request failed')
+            def finish(self):
+                pass
+        self.BufferedHandlerClass = BufferedHandler
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(address)
+        self.listen(64)
+        self.server_address = self.socket.getsockname()
+        self.executor = Executor(workers)
+        self.waker = Waker(self.map)
+        self.running = True
+        self.stopped = threading.Event()
+    def callSoon(self, func, *args):
+        self.waker.callSoon(func, *args)
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            AsyncHTTPConnection(pair[0], pair[1], self)
+    def handle_error(self):
+        if not AVOID_HTTP_SERVER_EXCEPTION_OUTPUT:
+            asyncore.dispatcher.handle_error(self)
+    def serve_forever(self):
+        try:
+            while self.running:
+                asyncore.loop(timeout = MAX_LOOP_WAIT, map = self.map, count = 1)
+            # Даём дописать уже начатые ответы, например на /shutdown
+            deadline = time.time() + MAX_LOOP_WAIT
+            while time.time() < deadline and any(isinstance(d, AsyncHTTPConnection) and (d.busy or d.outSize)
+                                                 for d in self.map.values()):
+                asyncore.loop(timeout = 0.05, map = self.map, count = 1)
+        finally:
+            for dispatcher in self.map.values():
+                dispatcher.close()
+            self.stopped.set()
+    def server_close(self):
+        self.running = False
+        self.callSoon(lambda: None)
+    def shutdown(self):
+        self.server_close()
+        self.stopped.wait()
+
+MAX_RANGES = 64     # больше диапазонов в одном Range - признак злоупотребления
+
+def parseByteRanges(header, size):
+    '''Диапазоны заголовка Range (RFC 7233) полуинтервалами, отсортированные
+    и слитые. None - заголовок не разобран и игнорируется (ответ 200),
+    пустой список - ни один диапазон не пересекается с файлом (ответ 416)'''
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    items = [item.strip() for item in spec.split(',') if item.strip()]
+    if not items or len(items) > MAX_RANGES:
+        return None
+    ranges = list()
+    for item in items:
+        first, sep, last = [x.strip() for x in item.partition('-')]
+        if not sep or not (first.isdigit() or last.isdigit()) or (first and not first.isdigit()) or (last and not last.isdigit()):
+            return None
+        if first:
+            start = int(first)
+            end = last and int(last) + 1 or size
+            if last and end <= start:
+                return None     # last-byte-pos меньше first-byte-pos
+            if start < size:
+                ranges.append((start, min(end, size)))
+        elif int(last) > 0:
+            ranges.append((max(size - int(last), 0), size))
+    ranges.sort()
+    merged = list()
+    for start, end in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
 def HttpHandlerFactory():
     class HttpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        deferStreaming = False
+        stream = None
+        openFile = None     # TorrentFile, открытый предыдущим запросом этого соединения
+        openFileKey = None
+        def handle_one_request(self):
+            if self.connection is not None:
+                # Плеер мог уйти, не закрыв соединение: открытый файл держал бы
+                # приоритет и срочные дедлайны своего окна
+                buffered = getattr(self.rfile, '_rbuf', None)     # уже прочитанный следующий запрос
+                if self.openFile is not None and buffered is not None and buffered.tell() == 0:
+                    ready, _, _ = select.select([self.connection], [], [], HTTP_IDLE_RELEASE)
+                    if not ready:
+                        self.closeOpenFile()
+                self.connection.settimeout(HTTP_KEEPALIVE_TIMEOUT)
+            BaseHTTPServer.BaseHTTPRequestHandler.handle_one_request(self)
+        def parse_request(self):
+            # Таймаут только на ожидание запроса: отдача на паузе плеера может стоять сколько угодно
+            if self.connection is not None:
+                self.connection.settimeout(None)
+            return BaseHTTPServer.BaseHTTPRequestHandler.parse_request(self)
+        def finish(self):
+            self.closeOpenFile()
+            BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+        def closeOpenFile(self):
+            if self.openFile is not None:
+                self.openFile.Close()
+                self.openFile = None
+        def sendBody(self, body, ctype, etag = None, headers = ()):
+            if etag is not None and etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+                self.send_response(304, 'Not Modified')
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-type", ctype)
+            self.send_header("Content-Length", len(body))
+            if etag is not None:
+                self.send_header("ETag", etag)
+                self.send_header("Cache-Control", "no-cache")
+            for name, value in headers:
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+        def sendJSON(self, obj):
+            self.sendBody(json.dumps(obj), "application/json")
+        def sendCachedJSON(self, tfs, key, version, build):
+            body, etag = tfs.cachedJSON(key, version, build)
+            self.sendBody(body, "application/json", etag)
         def do_GET(self):
             #print ('---Headers---\n%s\n' % (self.headers,))
             #print ('---Request---\n%s\n' % (self.path,))
-            if self.path == '/status':
-                self.statusHandler()
-            elif self.path == '/ls':
-                self.lsHandler()
-            elif self.path == '/peers':
-                self.peersHandler()
-            elif self.path == '/trackers':
-                self.trackersHandler()
-            elif self.path.startswith('/get/'):   # Неясно, зачем
-                return 
-            #    self.getHandler()                # этот запрос?
-            elif self.path == '/shutdown':
-                self.server.root_obj.forceShutdown = True
+            root = self.server.root_obj
+            url = urlparse.urlsplit(self.path)
+            if url.path == '/shutdown':
+                root.forceShutdown = True
                 self.server.server_close()
-                self.end_headers()
-                self.wfile.write('OK')
-            elif self.path.startswith('/files/'):
-                self.filesHandler()
+                self.close_connection = 1
+                self.sendBody('OK', 'text/plain')
+                return
+            if root.config.multi:
+                if url.path == '/add':
+                    return self.addHandler(urlparse.parse_qs(url.query))
+                elif url.path.startswith('/remove/'):
+                    return self.removeHandler(url.path[len('/remove/'):])
+                elif url.path == '/torrents':
+                    return self.torrentsHandler()
+            tfs, prefix, path = self.routeTorrent(url.path)
+            if url.path == '/metrics':
+                self.sendBody(root.Metrics(), 'text/plain; version=0.0.4')
+            elif path == '/events':
+                self.eventsHandler(urlparse.parse_qs(url.query), prefix and tfs.infoHash or None)
+            elif tfs is None:
+                self.send_error(404, 'Not found')
+            elif path == '/status':
+                self.statusHandler(tfs)
+            elif path == '/ls':
+                self.lsHandler(tfs, prefix)
+            elif path == '/peers':
+                self.peersHandler(tfs)
+            elif path == '/trackers':
+                self.trackersHandler(tfs)
+            elif path == '/pieces':
+                self.piecesHandler(tfs, urlparse.parse_qs(url.query))
+            elif path == '/prefetch':
+                self.prefetchHandler(tfs, urlparse.parse_qs(url.query))
+            elif path.startswith('/get/'):   # Неясно, зачем
+                self.send_error(404, 'Not found')
+            #    self.getHandler()                # этот запрос?
+            elif path.startswith('/files/'):
+                self.filesHandler(tfs, urllib.unquote(path[len('/files/'):]))
             else:
                 self.send_error(404, 'Not found')
-                self.end_headers()
-        def filesHandler(self):
-            #print('+++++start handle file+++++')
-            f, start_range, end_range = self.send_head()
-            #print('%s | %d | %d' % (repr(f), repr(start_range), repr(end_range)))
-            #print "Got values of ", start_range, " and ", end_range, "...\n"
-            if not f.closed:
-                #print('Reading file!!!!!!')
-                f.Seek(start_range, 0)
-                chunk = f.piece_length
-                total = 0
-                buf = bytearray(chunk)
-                while chunk > 0:
-                    if start_range + chunk > end_range:
-                        chunk = end_range - start_range
-                        buf = bytearray(chunk)
-                    try:
-                        f.Read(buf)
-                        self.wfile.write(buf)
-                    except:
-                        break
-                    total += chunk
-                    start_range += chunk
-                f.Close()
-        def send_head(self):
-            fname = urllib.unquote(self.path.lstrip('/files/'))
+        def routeTorrent(self, path):
+            '''Отделяет от пути префикс /<infohash>, если он есть.
+            Без префикса запрос относится к торренту из --uri'''
+            root = self.server.root_obj
+            parts = path.split('/', 2)
+            if len(parts) > 1 and len(parts[1]) == 40:
+                tfs = root.FindTorrent(parts[1])
+                if tfs is not None:
+                    return tfs, '/' + tfs.infoHash, '/' + (len(parts) > 2 and parts[2] or '')
+            return root.TorrentFS, '', path
+        def filesHandler(self, tfs, fname):
+            f, body = self.send_head(tfs, fname)
+            if f is None or f.closed:
+                return
+            if self.deferStreaming:
+                self.stream = lambda conn: FileStream(conn, f, body)   # Тело отдаст AsyncHTTPServer
+                return
+            try:
+                for part in body:
+                    if not isinstance(part, tuple):
+                        self.wfile.write(part)
+                        continue
+                    start_range, end_range = part
+                    f.Seek(start_range, 0)
+                    self.wfile.flush()
+                    while start_range < end_range:
+                        started = time.time()
+                        length = f.WaitForRange(start_range, min(end_range - start_range, STREAM_CHUNK))
+                        self.sendRange(f, start_range, length)
+                        # С sendfile чтение с диска и отправка - один вызов, так что замер включает и отправку
+                        f.tfs.root.metrics.observe('pyrrent2http_read_seconds', time.time() - started)
+                        start_range += length
+                self.wfile.flush()
+            except Exception:
+                # Плеер закрыл соединение или файл закрыт при завершении.
+                # Тело короче Content-Length, соединение больше не годится
+                self.close_connection = 1
+                self.closeOpenFile()
+        def sendRange(self, f, offset, length):
+            '''Отдаёт уже скачанный участок файла в сокет: из кэша кусков,
+            а без кэша - с диска без копирования через Python (свежескачанные куски - через readAt())'''
+            metrics = f.tfs.root.metrics
+            metrics.inc('pyrrent2http_http_bytes_total', length, file = f.Name(), info_hash = f.tfs.infoHash)
+            metrics.inc('pyrrent2http_read_bytes_total', length)
+            if f.tfs.pieceCache.enabled():
+                while length > 0:
+                    chunk = f.readAt(offset, length)
+                    self.connection.sendall(chunk)
+                    offset += len(chunk)
+                    length -= len(chunk)
+                return
+            while length > 0:
+                safe = f.diskSafe(offset, length)
+                if safe == 0:
+                    chunk = f.readAt(offset, length)
+                    self.connection.sendall(chunk)
+                    safe = len(chunk)
+                else:
+                    self.sendFromDisk(f, offset, safe)
+                offset += safe
+                length -= safe
+        def sendFromDisk(self, f, offset, length):
+            fileno = f.FilePtr().fileno()
+            if sendfile is not None:
+                while length > 0:
+                    sent = sendfile(self.connection.fileno(), fileno, offset, length)
+                    if sent == 0:
+                        raise IOError('Unexpected end of %s' % (f.SavePath(),))
+                    offset += sent
+                    length -= sent
+                return
+            aligned = offset - offset % mmap.ALLOCATIONGRANULARITY
+            mapped = mmap.mmap(fileno, offset - aligned + length, access = mmap.ACCESS_READ, offset = aligned)
+            try:
+                self.connection.sendall(buffer(mapped, offset - aligned, length))
+            finally:
+                mapped.close()
+        def openTorrentFile(self, tfs, fname):
+            '''Повторные запросы того же файла в одном соединении
+            (плееры так проверяют хвост файла) используют уже открытый TorrentFile'''
+            f = self.openFile
+            if f is not None and not f.closed and self.openFileKey == (tfs, fname):
+                return f
+            self.closeOpenFile()
+            self.openFile = tfs.Open(fname)
+            self.openFileKey = (tfs, fname)
+            return self.openFile
+        def send_head(self, tfs, fname):
+            '''Отправляет заголовки ответа и возвращает (файл, части тела),
+            где части - строки и диапазоны файла (start, end)'''
             try:
-                f =  self.server.root_obj.TorrentFS.Open(fname)
+                f = self.openTorrentFile(tfs, fname)
                 #print('++++file opening++++')
             except IOError:
                 self.send_error(404, "File not found")
-                return (None, 0, 0)
+                return (None, [])
             _, ext = os.path.splitext(fname)
             ctype = (ext != '' and ext in VIDEO_EXTS.keys())and VIDEO_EXTS[ext] or 'application/octet-stream'
+            size = f.size
+            lastModified = self.date_time_string(f.meta.mtime)
+            etag = '"%x-%x"' % (int(f.meta.mtime), size)
+            ranges = None
             if "Range" in self.headers:
-                self.send_response(206, 'Partial Content')
-            else:
+                ifRange = self.headers.get('If-Range')
+                # If-Range: диапазоны в силе, только если файл не изменился
+                if ifRange is None or ifRange.strip() in (etag, lastModified):
+                    ranges = parseByteRanges(self.headers['Range'], size)
+            if ranges is not None and not ranges:
+                self.send_response(416, 'Requested Range Not Satisfiable')
+                self.send_header("Content-Range", 'bytes */%d' % (size,))
+                self.send_header("Content-Length", 0)
+                self.end_headers()
+                return (None, [])
+            if ranges is None:
                 self.send_response(200)
-            self.send_header("Content-type", ctype)
+            else:
+                self.send_response(206, 'Partial Content')
             self.send_header('transferMode.dlna.org', 'Streaming')
-            size = f.size
-            start_range = 0
-            end_range = size
             self.send_header("Accept-Ranges", "bytes")
-            if "Range" in self.headers:
-                s, e = self.headers['range'][6:].split('-', 1)
-                sl = len(s)
-                el = len(e)
-                if sl > 0:
-                    start_range = int(s)
-                    if el > 0:
-                        end_range = int(e) + 1
-                elif el > 0:
-                    ei = int(e)
-                    if ei < size:
-                        start_range = size - ei
-            self.send_header("Content-Range", 'bytes ' + str(start_range) + '-' + str(end_range - 1) + '/' + str(size))
-            self.send_header("Content-Length", end_range - start_range)
-            self.send_header("Last-Modified", self.date_time_string(f.fileEntry.mtime))
+            self.send_header("Last-Modified", lastModified)
+            self.send_header("ETag", etag)
+            if ranges is None:
+                body = [(0, size)]
+                self.send_header("Content-type", ctype)
+                self.send_header("Content-Length", size)
+            elif len(ranges) == 1:
+                body = ranges
+                start_range, end_range = ranges[0]
+                self.send_header("Content-type", ctype)
+                self.send_header("Content-Range", 'bytes %d-%d/%d' % (start_range, end_range - 1, size))
+                self.send_header("Content-Length", end_range - start_range)
+            else:
+                boundary = '%032x' % (SystemRandom().getrandbits(128),)
+                body = list()
+                for start_range, end_range in ranges:
+                    body.append('\r\n--%s\r\nContent-type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' % (
+                                boundary, ctype, start_range, end_range - 1, size))
+                    body.append((start_range, end_range))
+                body.append('\r\n--%s--\r\n' % (boundary,))
+                self.send_header("Content-type", 'multipart/byteranges; boundary=' + boundary)
+                self.send_header("Content-Length", sum(isinstance(part, tuple) and part[1] - part[0] or len(part) for part in body))
             self.end_headers()
             #print "Sending Bytes ",start_range, " to ", end_range, "...\n"
-            return (f, start_range, end_range)
-        def statusHandler(self):
-            self.send_response(200)
-            self.send_header("Content-type", "application/json")
-            self.end_headers()
-            torrentHandle = self.server.root_obj.torrentHandle
+            return (f, body)
+        def statusHandler(self, tfs):
+            self.sendCachedJSON(tfs, 'status', tfs.statusVersion, tfs.StatusInfo)
+        def eventsHandler(self, query, infoHash):
+            '''/events - поток Server-Sent Events, /events?since=N - long-poll:
+            ответ сразу, если есть события новее N, иначе по первому событию или через EVENTS_KEEPALIVE'''
+            root = self.server.root_obj
+            bus = root.events
+            since = query.get('since', [None])[0]
+            if since is None:
+                since = self.headers.get('Last-Event-ID')
+                longPoll = False
+            else:
+                longPoll = True
             try:
-                info = torrentHandle.torrent_file()
-            except:
-                info = torrentHandle.get_torrent_info()
-            
-            tstatus = torrentHandle.status()
-            status = {
-                         'name'           :   info.name(),
-                         'state'          :   int(tstatus.state),
-                         'state_str'       :   str(tstatus.state),
-                         'error'          :   tstatus.error,
-                         'progress'       :   tstatus.progress,
-                         'download_rate'   :   tstatus.download_rate / 1024,
-                         'upload_rate'     :   tstatus.upload_rate / 1024,
-                         'total_download'  :   tstatus.total_download,
-                         'total_upload'    :   tstatus.total_upload,
-                         'num_peers'       :   tstatus.num_peers,
-                         'num_seeds'       :   tstatus.num_seeds,
-                         'total_seeds'     :   tstatus.num_complete,
-                         'total_peers'     :   tstatus.num_incomplete
-                         }
-            output = json.dumps(status)
-            self.wfile.write(output)
-        def lsHandler(self):
+                if since is not None:
+                    since = int(since)
+            except ValueError:
+                self.send_error(400, 'Bad since')
+                return
+            if longPoll:
+                events, seq = bus.since(since, infoHash)
+                if events or self.deferStreaming:
+                    if not events:
+                        # Ответ отдаст EventStream, когда появятся события
+                        self.send_response(200)
+                        self.send_header("Content-type", "application/json")
+                        self.send_header("Connection", "close")
+                        self.end_headers()
+                        self.close_connection = 1
+                        self.stream = lambda conn: EventStream(conn, bus, since, infoHash, False)
+                        return
+                    self.sendJSON({'seq': seq, 'events': jsonEvents(events)})
+                    return
+                wakeup = threading.Event()
+                bus.subscribe(wakeup)
+                try:
+                    # События других торрентов будят, но не завершают ожидание
+                    deadline = time.time() + EVENTS_KEEPALIVE
+                    while True:
+                        wakeup.clear()
+                        events, seq = bus.since(since, infoHash)
+                        remaining = deadline - time.time()
+                        if events or remaining <= 0:
+                            break
+                        wakeup.wait(remaining)
+                        if bus.seq == seq:
+                            break   # Разбудил keepAlive
+                finally:
+                    bus.unsubscribe(wakeup)
+                self.sendJSON({'seq': seq, 'events': jsonEvents(events)})
+                return
             self.send_response(200)
-            self.send_header("Content-type", "application/json")
+            self.send_header("Content-type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Connection", "close")
             self.end_headers()
+            self.close_connection = 1
+            if since is None:
+                # Новый клиент сначала получает полное состояние, у каждого события свой номер
+                torrents = [tfs for tfs in root.Torrents() if infoHash is None or tfs.infoHash == infoHash]
+                first = bus.allocate(len(torrents))
+                since = first + len(torrents) - 1
+                self.wfile.write(formatEvents([(first + i, 'status', dict(tfs.StatusInfo(), info_hash = tfs.infoHash))
+                                               for i, tfs in enumerate(torrents)]))
+            if self.deferStreaming:
+                self.stream = lambda conn: EventStream(conn, bus, since, infoHash, True)
+                return
+            wakeup = threading.Event()
+            bus.subscribe(wakeup)
+            try:
+                ping = ''
+                while not root.forceShutdown:
+                    wakeup.clear()
+                    events, seq = bus.since(since, infoHash)
+                    since = seq
+                    self.wfile.write(formatEvents(events) or ping)
+                    self.wfile.flush()
+                    wakeup.wait(EVENTS_KEEPALIVE)
+                    ping = ': keep-alive\n\n'   # Разбудили без событий
+            except socket.error:
+                pass    # Клиент отключился
+            finally:
+                bus.unsubscribe(wakeup)
+        def lsHandler(self, tfs, prefix):
+            version = (tfs.HasTorrentInfo(), tfs.progressVersion)
+            self.sendCachedJSON(tfs, 'ls' + prefix, version, lambda: self.filesInfo(tfs, prefix))
+        def filesInfo(self, tfs, prefix):
             retFiles = {'files': []}
-            if self.server.root_obj.TorrentFS.HasTorrentInfo():
-                files = self.server.root_obj.TorrentFS.Files()
+            if tfs.HasTorrentInfo():
+                files = tfs.Files()
                 for file_ in files:
-                    Url = 'http://' + self.server.root_obj.config.bindAddress + '/files/' + urllib.quote(file_.Name())
+                    Url = 'http://' + self.server.root_obj.config.bindAddress + prefix + '/files/' + urllib.quote(file_.path)
                     fi = {
-                          'name':       file_.Name(),
+                          'name':       file_.path,
                           'size':       file_.size,
                           'offset':     file_.offset,
-                          'download':   file_.Downloaded(),
-                          'progress':   file_.Progress(),
-                          'save_path':   file_.SavePath(),
+                          'download':   tfs.getFileDownloadedBytes(file_.index),
+                          'progress':   tfs.getFileProgress(file_.index),
+                          'save_path':   file_.savePath,
                           'url':        Url
                           }
                     retFiles['files'].append(fi)
-            output = json.dumps(retFiles)
-            self.wfile.write(output)
-        def peersHandler(self):
-            self.send_response(200)
-            self.send_header("Content-type", "application/json")
-            self.end_headers()
-            torrentHandle = self.server.root_obj.torrentHandle
+            return retFiles
+        def piecesHandler(self, tfs, query):
+            '''/pieces[?file=<путь>][&format=binary] - скачанные куски торрента или файла:
+            упакованная битовая карта (base64 в JSON или тело application/octet-stream),
+            серии скачанных кусков, дедлайны и курсоры читателей'''
+            if not tfs.HasTorrentInfo():
+                self.send_error(404, 'No metadata')
+                return
+            meta = None
+            name = query.get('file', [None])[0]
+            if name is not None:
+                meta = tfs.FileMetaByName(name)
+                if meta is None:
+                    self.send_error(404, 'Not found')
+                    return
+            if meta is None:
+                first, count = 0, tfs.pieceMap.count
+            else:
+                first, count = meta.startPiece, meta.endPiece - meta.startPiece + 1
+            key = 'pieces:%d:%d' % (first, count)
+            if query.get('format', [None])[0] == 'binary':
+                body, etag = tfs.cachedBody(key + ':binary', tfs.piecesVersion, lambda: tfs.pieceMap.bitfield(first, count))
+                self.sendBody(body, 'application/octet-stream', etag,
+                              (('X-Pieces-First', first), ('X-Pieces-Count', count)))
+                return
+            readers = [f for f in list(tfs.openedFiles) if f.cursorPiece is not None and first <= f.cursorPiece < first + count]
+            version = (tfs.piecesVersion, tfs.deadlinesVersion, tuple((f.num, f.cursorPiece, f.position) for f in readers))
+            self.sendCachedJSON(tfs, key, version, lambda: self.piecesInfo(tfs, meta, first, count, readers))
+        def prefetchHandler(self, tfs, query):
+            '''/prefetch?file=<путь> - заранее скачать начало и индекс файла, который скоро откроют'''
+            name = query.get('file', [None])[0]
+            meta = tfs.HasTorrentInfo() and name is not None and tfs.FileMetaByName(name) or None
+            if meta is None:
+                self.send_error(404, 'Not found')
+                return
+            self.sendJSON({'file': meta.path, 'missing_pieces': tfs.Prefetch(meta)})
+        def piecesInfo(self, tfs, meta, first, count, readers):
+            pieceMap = tfs.pieceMap
+            deadlines = []
+            for p in sorted(p for p in list(tfs.deadlineDue) if first <= p < first + count):
+                if deadlines and deadlines[-1][0] + deadlines[-1][1] == p:
+                    deadlines[-1][1] += 1
+                else:
+                    deadlines.append([p, 1])
+            return {
+                    'file':         meta is not None and meta.path or None,
+                    'piece_length': tfs.info.piece_length(),
+                    'first_piece':  first,
+                    'num_pieces':   count,
+                    'have':         pieceMap.total(first, count),
+                    'bitfield':     base64.b64encode(pieceMap.bitfield(first, count)),
+                    'runs':         pieceMap.runs(first, count),
+                    'deadlines':    deadlines,
+                    'readers':      [{'index': f.index, 'name': f.Name(), 'position': f.position,
+                                      'cursor_piece': f.cursorPiece, 'buffered_pieces': f.bufferedPieces()} for f in readers]
+                    }
+        def peersHandler(self, tfs):
+            self.sendCachedJSON(tfs, 'peers', tfs.statusVersion, lambda: self.peersInfo(tfs))
+        def peersInfo(self, tfs):
             ret = list()
-            for peer in torrentHandle.get_peer_info():
+            for peer in tfs.handle.get_peer_info():
                 if peer.flags & peer.connecting or peer.flags & peer.handshake:
                     continue
                 pi = {
@@ -594,21 +2715,17 @@ def HttpHandlerFactory():
                        'Client':        peer.client
                        }
                 ret.append(pi)
-            output = json.dumps(ret)
-            self.wfile.write(output)
-        def trackersHandler(self):
-            self.send_response(200)
-            self.send_header("Content-type", "application/json")
-            self.end_headers()
+            return ret
+        def trackersHandler(self, tfs):
+            self.sendCachedJSON(tfs, 'trackers', tfs.statusVersion, lambda: self.trackersInfo(tfs))
+        def trackersInfo(self, tfs):
             ret = list()
-            try:
-                self.info = self.server.root_obj.torrentHandler.torrent_file()
-            except:
-                self.info = self.server.root_obj.torrentHandler.get_torrent_info()
-            for tracker in info.trackers():
+            trackers = tfs.HasTorrentInfo() and tfs.info.trackers() or []
+            nextAnnounce = tfs.Status().next_announce.seconds
+            for tracker in trackers:
                 pi = {
                         'Url':                tracker.url,
-                        'NextAnnounceIn':        self.server.root_obj.torrentHandler.status().next_announce.seconds,
+                        'NextAnnounceIn':        nextAnnounce,
                         'MinAnnounceIn':        10, # FIXME неясно, откуда брать
                         'ErrorCode':            0, #FIXME неясно, откуда брать
                         'ErrorMessage':        u'', #FIXME неясно, откуда брать
@@ -623,8 +2740,41 @@ def HttpHandlerFactory():
                         'CompleteSent':        tracker.complete_sent,
                         }
                 ret.append(pi)
-            output = json.dumps(ret)
-            self.wfile.write(output)
+            return ret
+        def addHandler(self, query):
+            uri = query.get('uri', [''])[0]
+            if uri == '':
+                self.send_error(400, 'Missing uri')
+                return
+            try:
+                tfs = self.server.root_obj.AddTorrent(uri)
+            except Exception as e:
+                logging.error(e.args)
+                self.send_error(400, 'Could not add torrent')
+                return
+            self.sendJSON({'info_hash': tfs.infoHash, 'name': tfs.Name()})
+        def removeHandler(self, infoHash):
+            root = self.server.root_obj
+            tfs = root.FindTorrent(infoHash)
+            if tfs is None:
+                self.send_error(404, 'Not found')
+                return
+            if tfs is root.TorrentFS:
+                self.send_error(403, 'Torrent from --uri can not be removed')
+                return
+            root.RemoveTorrent(infoHash)
+            self.sendBody('OK', 'text/plain')
+        def torrentsHandler(self):
+            ret = list()
+            for tfs in self.server.root_obj.Torrents():
+                tstatus = tfs.Status()
+                ret.append({
+                            'info_hash':    tfs.infoHash,
+                            'name':         tfs.Name(),
+                            'state':        int(tstatus.state),
+                            'progress':     tstatus.progress,
+                            })
+            self.sendJSON(ret)
         def log_message(self, format, *args):
             return
     return HttpHandler
@@ -632,9 +2782,19 @@ def HttpHandlerFactory():
 class Pyrrent2http(object):
     def __init__(self):
         self.torrentHandle = None
+        self.TorrentFS = None
+        self.torrents = dict()
+        self.torrentsLock = threading.Lock()
         self.forceShutdown = False
         self.session = None
         self.magnet = False
+        self.events = EventBus()
+        self.metrics = Metrics(METRICS)
+        self.sessionStats = None
+        self.stateWriter = None
+        self.torrentFetch = None
+        self.pendingRemovals = dict()   # infohash -> файлы, удаляемые после torrent_removed_alert
+        self.removals = list()          # [(файл, сколько ещё попыток)]
     def parseFlags(self):
         parser = argparse.ArgumentParser(add_help=True, version=VERSION)
         parser.add_argument('--uri', type=str, default='', help='Magnet URI or .torrent file URL', dest='uri')
@@ -653,6 +2813,9 @@ class Pyrrent2http(object):
         parser.add_argument('--exit-on-finish', nargs='?', action=BoolArg, default=False, help='Exit when download finished', dest='exitOnFinish', choices=('true', 'false'))
         parser.add_argument('--resume-file', type=str, default='', help='Use fast resume file', dest='resumeFile')
         parser.add_argument('--state-file', type=str, default='', help='Use file for saving/restoring session state', dest='stateFile')
+        parser.add_argument('--torrent-cache', type=str, default='', help='Directory for caching .torrent files fetched by URL (honours ETag, Last-Modified and max-age)', dest='torrentCache')
+        parser.add_argument('--fetch-timeout', type=float, default=15, help='Connect and read timeout for fetching .torrent files by URL (seconds)', dest='fetchTimeout')
+        parser.add_argument('--metadata-cache', type=str, default='', help='Directory for caching metadata of magnet links, so reopened magnets start without waiting for peers', dest='metadataCache')
         parser.add_argument('--user-agent', type=str, default=USER_AGENT, help='Set an user agent', dest='userAgent')
         parser.add_argument('--dht-routers', type=str, default='', help='Additional DHT routers (comma-separated host:port pairs)', dest='dhtRouters')
         parser.add_argument('--trackers', type=str, default='', help='Additional trackers (comma-separated URLs)', dest='trackers')
@@ -661,6 +2824,14 @@ class Pyrrent2http(object):
         parser.add_argument('--connection-speed', type=int, default=50, help='The number of peer connection attempts that are made per second', dest='connectionSpeed')
         parser.add_argument('--peer-connect-timeout', type=int, default=15, help='The number of seconds to wait after a connection attempt is initiated to a peer', dest='peerConnectTimeout')
         parser.add_argument('--request-timeout', type=int, default=20, help='The number of seconds until the current front piece request will time out', dest='requestTimeout')
+        parser.add_argument('--readahead-seconds', type=int, default=20, help='Size of the streaming read-ahead window in seconds of playback', dest='readaheadSeconds')
+        parser.add_argument('--memory-storage', nargs='?', action=BoolArg, default=False, help='Keep downloaded data in a RAM filesystem instead of --dl-path', dest='memoryStorage', choices=('true', 'false'))
+        parser.add_argument('--memory-storage-size', type=int, default=256, help='Memory budget of --memory-storage (MiB); once it is used up, downloading stops and reads of missing pieces fail', dest='memoryStorageSize')
+        parser.add_argument('--memory-storage-path', type=str, default='', help='RAM filesystem for --memory-storage (default: /dev/shm)', dest='memoryStoragePath')
+        parser.add_argument('--prefetch-next', type=int, default=0, help='Prefetch the beginning of this many files following the opened one (next episodes)', dest='prefetchNext')
+        parser.add_argument('--prefetch-size', type=int, default=16, help='How much of the beginning of a file to prefetch with --prefetch-next and /prefetch (MiB)', dest='prefetchSize')
+        parser.add_argument('--piece-cache-size', type=int, default=0, help='Memory budget of the per-torrent cache of recently read pieces (MiB, 0 = read straight from disk)', dest='pieceCacheSize')
+        parser.add_argument('--piece-wait-timeout', type=int, default=0, help='The number of seconds an HTTP reader waits for a missing piece before giving up (0 = wait forever)', dest='pieceWaitTimeout')
         parser.add_argument('--dl-rate', type=int, default=-1, help='Max download rate (kB/s)', dest='maxDownloadRate')
         parser.add_argument('--ul-rate', type=int, default=-1, help='Max upload rate (kB/s)', dest='maxUploadRate')
         parser.add_argument('--connections-limit', type=int, default=200, help='Set a global limit on the number of connections opened', dest='connectionsLimit')
@@ -676,11 +2847,18 @@ class Pyrrent2http(object):
         parser.add_argument('--enable-natpmp', nargs='?', action=BoolArg, default=True, help='Enable NATPMP (NAT port-mapping)', dest='enableNATPMP', choices=('true', 'false'))
         parser.add_argument('--enable-utp', nargs='?', action=BoolArg, default=True, help='Enable uTP protocol', dest='enableUTP', choices=('true', 'false'))
         parser.add_argument('--enable-tcp', nargs='?', action=BoolArg, default=True, help='Enable TCP protocol', dest='enableTCP', choices=('true', 'false'))
+        parser.add_argument('--multi', nargs='?', action=BoolArg, default=False, help='Serve many torrents in one session (/add?uri=, /remove/<infohash>, /<infohash>/files/...)', dest='multi', choices=('true', 'false'))
+        parser.add_argument('--async-http', nargs='?', action=BoolArg, default=False, help='Serve HTTP from one event loop instead of a thread per connection', dest='asyncHttp', choices=('true', 'false'))
+        parser.add_argument('--http-workers', type=int, default=4, help='Number of worker threads for blocking calls of --async-http', dest='httpWorkers')
+        parser.add_argument('--housekeeping-interval', type=float, default=0.5, help='Interval of file progress updates and exit-on-finish checks (seconds)', dest='housekeepingInterval')
+        parser.add_argument('--stats-interval', type=float, default=30, help='Interval of stats output (seconds)', dest='statsInterval')
+        parser.add_argument('--resume-interval', type=float, default=5, help='Interval of fast resume data saves (seconds)', dest='resumeInterval')
+        parser.add_argument('--watchdog-interval', type=float, default=1, help='Interval of parent process checks (seconds)', dest='watchdogInterval')
         config_ = parser.parse_args()
         self.config = AttributeDict()
         for k in config_.__dict__.keys():
             self.config[k] = config_.__dict__[k]
-        if self.config.uri == '':
+        if self.config.uri == '' and not self.config.multi:
             parser.print_usage()
             sys.exit(1)
         if self.config.uri.startswith('magnet:'):
@@ -688,77 +2866,223 @@ class Pyrrent2http(object):
         if self.config.resumeFile != '' and not self.config.keepFiles:
             logging.error('Usage of option --resume-file is allowed only along with --keep-files')
             sys.exit(1)
+        if self.config.memoryStorage:
+            if self.config.keepFiles or self.config.keepComplete or self.config.keepIncomplete:
+                logging.error('Option --memory-storage can not be used along with --keep-* options')
+                sys.exit(1)
+            if self.config.noSparseFile:
+                logging.error('Option --memory-storage can not be used along with --no-sparse')
+                sys.exit(1)
+            ramPath = self.config.memoryStoragePath or (os.path.isdir('/dev/shm') and '/dev/shm' or '')
+            if ramPath == '':
+                logging.error('No RAM filesystem found for --memory-storage, specify one with --memory-storage-path')
+                sys.exit(1)
+            try:
+                self.config.downloadPath = tempfile.mkdtemp(prefix = 'pyrrent2http-', dir = ramPath)
+            except OSError as e:
+                logging.error('Can not use %s for --memory-storage: %s', ramPath, e)
+                sys.exit(1)
+        self.stateWriter = StateWriter(self.config.resumeInterval)
+        for cacheDir in (self.config.metadataCache, self.config.torrentCache):
+            if cacheDir != '' and not os.path.isdir(cacheDir):
+                try:
+                    os.makedirs(cacheDir)
+                except OSError as e:
+                    logging.error('Can not create cache directory %s: %s', cacheDir, e)
+                    sys.exit(1)
     
-    def buildTorrentParams(self, uri):
+    def buildTorrentParams(self, uri, resumeFile = ''):
         fileUri = urlparse.urlparse(uri)
+        magnet = uri.startswith('magnet:')
         torrentParams = {}
-        if self.magnet:
+        torrent_info = magnet and self.loadMetadata(uri) or None
+        if torrent_info is not None:
+            torrentParams['ti'] = torrent_info
+            trackers = urlparse.parse_qs(urlparse.urlsplit(uri).query).get('tr')
+            if trackers:
+                torrentParams['trackers'] = trackers
+        elif magnet:
             torrentParams['url'] =  uri
         elif fileUri.scheme == 'file':
             uriPath = fileUri.path
             if uriPath != '' and platform.system().lower() == 'windows' and (os.path.sep == uriPath[0] or uriPath[0] == '/'):
                 uriPath = uriPath[1:]
-            try:
-                absPath = os.path.abspath(uriPath)
-                logging.info('Opening local file: %s', absPath)
-                with open(absPath, 'rb') as f:
-                    torrent_info = lt.torrent_info(lt.bdecode(f.read()))
-            except Exception as e:
-                strerror = e.args
-                logging.error(strerror)
-                sys.exit(1)
+            absPath = os.path.abspath(uriPath)
+            logging.info('Opening local file: %s', absPath)
+            with open(absPath, 'rb') as f:
+                torrent_info = lt.torrent_info(lt.bdecode(f.read()))
             torrentParams['ti'] = torrent_info
         else:
-            logging.info('Will fetch: %s', uri)
-            try:
-                torrent_raw = urllib.urlopen(uri).read()
-                torrent_info = lt.torrent_info(torrent_raw, len(torrent_raw))
-            except Exception as e:
-                strerror = e.args
-                logging.error(strerror)
-                sys.exit(1)
+            fetch = self.torrentFetch
+            if fetch is None or fetch.uri != uri:
+                logging.info('Will fetch: %s', uri)
+                fetch = TorrentFetch(self, uri)
+            torrent_raw = fetch.result()
+            torrent_info = lt.torrent_info(torrent_raw, len(torrent_raw))
             torrentParams['ti'] = torrent_info
         logging.info('Setting save path: %s', self.config.downloadPath)
         torrentParams['save_path'] = self.config.downloadPath
-        
-        if os.path.exists(self.config.resumeFile):
-            logging.info('Loading resume file: %s', self.config.resumeFile)
-            try:
-                with open(self.config.resumeFile, 'rb') as f:
-                    torrentParams['resume_data'] = lt.bencode(f.read())
-            except Exception as e:
-                strerror = e.args
-                logging.error(strerror)
-        if self.config.noSparseFile or self.magnet:
+        self.loadResumeData(torrentParams, resumeFile)
+        # Под --memory-storage файлы в RAM: предварительное выделение заняло бы память под весь торрент
+        if (self.config.noSparseFile or magnet) and not self.config.memoryStorage:
             logging.info('Disabling sparse file support...')
             torrentParams["storage_mode"] = lt.storage_mode_t.storage_mode_allocate
         return torrentParams
     
+    def loadResumeData(self, torrentParams, resumeFile):
+        if resumeFile == '' or not os.path.exists(resumeFile):
+            return
+        logging.info('Loading resume file: %s', resumeFile)
+        try:
+            with open(resumeFile, 'rb') as f:
+                resumeData = f.read()
+        except IOError as e:
+            strerror = e.args
+            logging.error(strerror)
+            return
+        # add_torrent() ждёт resume data в bencode, как она и записана на диск
+        try:
+            valid = lt.bdecode(resumeData) is not None
+        except Exception:
+            valid = False
+        if not valid:
+            logging.error('Resume file %s is corrupted, ignoring it', resumeFile)
+        else:
+            torrentParams['resume_data'] = resumeData
+    def resumeFileFor(self, infoHash):
+        '''Файл resume data торрента, добавленного через /add: рядом с --resume-file'''
+        if self.config.resumeFile == '' or infoHash is None:
+            return ''
+        return '%s.%s' % (self.config.resumeFile, infoHash.lower())
+    def metadataCachePath(self, infoHash):
+        return os.path.join(self.config.metadataCache, infoHash.lower() + '.torrent')
+    def loadMetadata(self, uri):
+        '''torrent_info магнита из --metadata-cache или None'''
+        infoHash = magnetInfoHash(uri)
+        if self.config.metadataCache == '' or infoHash is None:
+            return None
+        path = self.metadataCachePath(infoHash)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                torrent_info = lt.torrent_info(lt.bdecode(f.read()))
+            if str(torrent_info.info_hash()).lower() != infoHash:
+                raise ValueError('infohash mismatch')
+        except Exception as e:
+            logging.error('Ignoring broken cached metadata %s: %s', path, e)
+            return None
+        logging.info('Using cached metadata: %s', path)
+        return torrent_info
+    def saveMetadata(self, tfs):
+        '''Сохраняет полученные от пиров метаданные магнита в --metadata-cache'''
+        if self.config.metadataCache == '' or not tfs.HasTorrentInfo():
+            return
+        path = self.metadataCachePath(tfs.infoHash)
+        if os.path.exists(path):
+            return
+        logging.info('Caching metadata to: %s', path)
+        # Байты словаря info как есть: после bdecode/bencode неканонический словарь
+        # дал бы другой infohash, и loadMetadata() отверг бы копию
+        self.stateWriter.save(path, 'd4:info' + tfs.info.metadata() + 'e')
+    def startFetch(self):
+        '''Начинает скачивать .torrent из --uri, чтобы это шло параллельно запуску сессии'''
+        scheme = urlparse.urlparse(self.config.uri).scheme
+        if scheme in ('http', 'https'):
+            logging.info('Will fetch: %s', self.config.uri)
+            self.torrentFetch = TorrentFetch(self, self.config.uri)
     def addTorrent(self):
-        self.torrentParams = self.buildTorrentParams(self.config.uri)
+        if self.config.uri == '':
+            logging.info('No --uri specified, waiting for torrents to be added via /add')
+            return
+        try:
+            self.torrentParams = self.buildTorrentParams(self.config.uri, self.config.resumeFile)
+        except Exception as e:
+            strerror = e.args
+            logging.error(strerror)
+            sys.exit(1)
+        self.TorrentFS = self.startTorrent(self.torrentParams, self.config.fileIndex, self.config.resumeFile)
+        self.torrentHandle = self.TorrentFS.handle
+    
+    def startTorrent(self, torrentParams, fileIndex, resumeFile = ''):
         logging.info('Adding torrent')
-        self.torrentHandle = self.session.add_torrent(self.torrentParams)
-        #self.torrentHandle.set_sequential_download(True)
-        #
-        # Хороший флаг, но не в нашем случае. Мы сам указываем, какие куски нам нужны (handle.set_piece_deadline)
-        # Также, у нас перемотка. Т.е. произвольный доступ.
-        # Значит, последовательная загрузка нам будет только вредить
-        if self.config.trackers != '':
-            trackers    = self.config.trackers.split(',')
-            startTier   = 256 - len(trackers)
-            for n in range(len(trackers)):
-                tracker = trackers[n].strip()
-                logging.info('Adding tracker: %s', tracker)
-                self.torrentHandle.add_tracker(tracker, startTier + n)
-        if self.config.enableScrape:
-            logging.info('Sending scrape request to tracker')
-            self.torrentHandle.scrape_tracker()
+        with self.torrentsLock:
+            torrentHandle = self.session.add_torrent(torrentParams)
+            infoHash = str(torrentHandle.info_hash())
+            if infoHash in self.torrents:
+                return self.torrents[infoHash]
+            #torrentHandle.set_sequential_download(True)
+            #
+            # Хороший флаг, но не в нашем случае. Мы сам указываем, какие куски нам нужны (handle.set_piece_deadline)
+            # Также, у нас перемотка. Т.е. произвольный доступ.
+            # Значит, последовательная загрузка нам будет только вредить
+            if self.config.trackers != '':
+                trackers    = self.config.trackers.split(',')
+                startTier   = 256 - len(trackers)
+                for n in range(len(trackers)):
+                    tracker = trackers[n].strip()
+                    logging.info('Adding tracker: %s', tracker)
+                    torrentHandle.add_tracker(tracker, startTier + n)
+            if self.config.enableScrape:
+                logging.info('Sending scrape request to tracker')
+                torrentHandle.scrape_tracker()
+            tfs = TorrentFS(self, torrentHandle, fileIndex, torrentParams['save_path'])
+            tfs.resumeFile = resumeFile
+            self.torrents[infoHash] = tfs
+        logging.info('Downloading torrent: %s', tfs.Name())
+        return tfs
+
+    def AddTorrent(self, uri):
+        torrentParams = self.buildTorrentParams(uri)
+        info = torrentParams.get('ti')
+        resumeFile = self.resumeFileFor(info is not None and str(info.info_hash()) or magnetInfoHash(uri))
+        self.loadResumeData(torrentParams, resumeFile)
+        return self.startTorrent(torrentParams, -1, resumeFile)
+
+    def RemoveTorrent(self, infoHash):
+        with self.torrentsLock:
+            tfs = self.torrents.pop(infoHash.lower(), None)
+        if tfs is None:
+            return False
+        tfs.Shutdown()
+        self.removeTorrent(tfs, False)
+        return True
+
+    def FindTorrent(self, infoHash):
+        with self.torrentsLock:
+            return self.torrents.get(infoHash.lower())
+
+    def Torrents(self):
+        with self.torrentsLock:
+            return self.torrents.values()
+
+    def Metrics(self):
+        '''Текст /metrics: накопленные счётчики и значения, собираемые в момент запроса'''
+        torrents = self.Torrents()
+        def perTorrent(value):
+            return [((('info_hash', tfs.infoHash),), value(tfs)) for tfs in torrents]
+        extra = [
+            ('pyrrent2http_download_rate_bytes', 'gauge', 'Download rate', perTorrent(lambda tfs: tfs.Status().download_rate)),
+            ('pyrrent2http_upload_rate_bytes', 'gauge', 'Upload rate', perTorrent(lambda tfs: tfs.Status().upload_rate)),
+            ('pyrrent2http_peers', 'gauge', 'Connected peers', perTorrent(lambda tfs: tfs.Status().num_peers)),
+            ('pyrrent2http_progress_ratio', 'gauge', 'Torrent progress', perTorrent(lambda tfs: tfs.Status().progress)),
+            ('pyrrent2http_open_files', 'gauge', 'Opened TorrentFile objects', perTorrent(lambda tfs: len(tfs.openedFiles))),
+            ('pyrrent2http_piece_cache_bytes', 'gauge', 'Size of the piece cache', perTorrent(lambda tfs: tfs.pieceCache.size)),
+            ('pyrrent2http_piece_cache_hits_total', 'counter', 'Piece cache hits', perTorrent(lambda tfs: tfs.pieceCache.hits)),
+            ('pyrrent2http_piece_cache_misses_total', 'counter', 'Piece cache misses', perTorrent(lambda tfs: tfs.pieceCache.misses)),
+        ]
+        stats = self.sessionStats
+        if stats is not None:
+            if not isinstance(stats, dict):
+                stats = dict((metric.name, stats[metric.value_index]) for metric in lt.session_stats_metrics())
+            for name, value in sorted(stats.items()):
+                extra.append(('libtorrent_' + name.replace('.', '_'), 'untyped', 'libtorrent session counter ' + name, [((), value)]))
+        return self.metrics.render(extra)
+    def torrentFSByHandle(self, handle):
         try:
-            info = self.torrentHandle.torrent_file()
-        except:
-            info = self.torrentHandle.get_torrent_info()
-        logging.info('Downloading torrent: %s', info.name())
-        self.TorrentFS = TorrentFS(self, self.torrentHandle, self.config.fileIndex)
+            return self.FindTorrent(str(handle.info_hash()))
+        except Exception:
+            return None
     
     def startHTTP(self):
         #def http_server_loop(listener, alive):
@@ -774,7 +3098,10 @@ class Pyrrent2http(object):
         host, strport = self.config.bindAddress.split(':')
         if len(strport) > 0:
             srv_port = int(strport)
-        self.httpListener = ThreadingHTTPServer((host, srv_port), handler)
+        if self.config.asyncHttp:
+            self.httpListener = AsyncHTTPServer((host, srv_port), handler, self.config.httpWorkers)
+        else:
+            self.httpListener = ThreadingHTTPServer((host, srv_port), handler)
         self.httpListener.root_obj = self
         #self.httpListener.timeout = 0.5
         #thread = threading.Thread(target = http_server_loop, args = (self.httpListener, self.main_alive))
@@ -802,7 +3129,9 @@ class Pyrrent2http(object):
         alertMask = (lt.alert.category_t.error_notification | 
                      lt.alert.category_t.storage_notification | 
                      lt.alert.category_t.tracker_notification |
-                     lt.alert.category_t.status_notification)
+                     lt.alert.category_t.status_notification |
+                     getattr(lt.alert.category_t, 'piece_progress_notification',
+                             lt.alert.category_t.progress_notification))
         if self.config.debugAlerts:
             alertMask |= lt.alert.category_t.debug_notification
         self.session.set_alert_mask(alertMask)
@@ -888,7 +3217,11 @@ class Pyrrent2http(object):
             logging.info('Encryption not supported: %s' % (e.args,))
         
     def stats(self):
-        status = self.torrentHandle.status()
+        for tfs in self.Torrents():
+            self.torrentStats(tfs)
+
+    def torrentStats(self, tfs):
+        status = tfs.handle.status()
         dhtStatusStr = ''
         if not status.has_metadata:
             return
@@ -899,7 +3232,8 @@ class Pyrrent2http(object):
             errorStr = ''
             if len(status.error) > 0:
                 errorStr = ' (%s)' % (status.error,)
-            logging.info('%s, overall progress: %.2f%%, dl/ul: %.3f/%.3f kbps, peers/seeds: %d/%d'  % (
+            nameStr = self.config.multi and '%s: ' % (tfs.Name(),) or ''
+            logging.info(nameStr + '%s, overall progress: %.2f%%, dl/ul: %.3f/%.3f kbps, peers/seeds: %d/%d'  % (
                           str(status.state),
                           status.progress * 100,
                           float(status.download_rate)/1024,
@@ -908,19 +3242,54 @@ class Pyrrent2http(object):
                           status.num_seeds
                           ) + dhtStatusStr + errorStr
                          )
-            if self.config.showFilesProgress or self.config.showAllStats:
+            # has_metadata бывает true раньше, чем onMetadata() заполнит TorrentFS, а Files() ждал бы его
+            if (self.config.showFilesProgress or self.config.showAllStats) and tfs.HasTorrentInfo():
                 str_ = 'Files: '
-                for i, f in enumerate(self.TorrentFS.Files()):
-                    str_ += '[%d] %.2f%% ' % (i, f.Progress()*100)
+                for i in range(len(tfs.Files())):
+                    str_ += '[%d] %.2f%% ' % (i, tfs.getFileProgress(i)*100)
                 logging.info(str_)
-            if (self.config.showPiecesProgress or self.config.showAllStats) and self.TorrentFS.LastOpenedFile() != None:
-                self.TorrentFS.LastOpenedFile().ShowPieces()
+            if (self.config.showPiecesProgress or self.config.showAllStats) and tfs.LastOpenedFile() != None:
+                tfs.LastOpenedFile().ShowPieces()
 
     def consumeAlerts(self):
         alerts = self.session.pop_alerts()
+        progressed = set()
         for alert in alerts:
             if isinstance(alert, lt.save_resume_data_alert):
                 self.processSaveResumeDataAlert(alert)
+            elif isinstance(alert, lt.piece_finished_alert):
+                tfs = self.torrentFSByHandle(alert.handle)
+                if tfs is not None:
+                    tfs.onPieceFinished(alert.piece_index)
+                    progressed.add(tfs)
+            elif isinstance(alert, lt.read_piece_alert):
+                tfs = self.torrentFSByHandle(alert.handle)
+                if tfs is not None:
+                    error = getattr(alert, 'error', None)
+                    failed = error is not None and error.value() != 0
+                    if failed:
+                        logging.warning('Failed to read piece %d: %s', alert.piece, error.message())
+                    tfs.pieceCache.finishRead(alert.piece, not failed and alert.buffer or None)
+                    tfs.pieceDispatcher.notify(alert.piece)
+            elif isinstance(alert, lt.session_stats_alert):
+                self.sessionStats = alert.values
+            elif isinstance(alert, lt.state_update_alert):
+                for status in alert.status:
+                    tfs = self.torrentFSByHandle(status.handle)
+                    if tfs is not None:
+                        tfs.updateStatus(status)
+            elif isinstance(alert, lt.torrent_removed_alert):
+                files = self.pendingRemovals.pop(str(alert.info_hash), None)
+                if files:
+                    self.removals.extend((file, REMOVE_ATTEMPTS) for file in files)
+                    self.retryRemovals()
+            elif isinstance(alert, lt.metadata_received_alert):
+                tfs = self.torrentFSByHandle(alert.handle)
+                if tfs is not None:
+                    tfs.waitForMetadata()
+                    self.saveMetadata(tfs)
+        for tfs in progressed:
+            tfs.publishBuffers()
     def waitForAlert(self, alertClass, timeout):
         start = time.time()
         while True:
@@ -931,48 +3300,74 @@ class Pyrrent2http(object):
                 alert = self.session.pop_alert()
                 if isinstance(alert, alertClass):
                     return alert
+    def housekeeping(self):
+        # Снимки torrent_status придут state_update_alert'ом, только для изменившихся торрентов
+        postUpdates = hasattr(self.session, 'post_torrent_updates')
+        if postUpdates:
+            self.session.post_torrent_updates()
+        self.retryRemovals()
+        for tfs in self.Torrents():
+            tfs.pieceDispatcher.wakeAll()
+            tfs.waitForMetadata()
+            if tfs.HasTorrentInfo():
+                tfs.LoadFileProgress()
+                tfs.applyPrefetch()
+            if tfs.memoryStorage is not None:
+                tfs.memoryStorage.check()
+            if not postUpdates:
+                tfs.updateStatus(tfs.handle.status())
+            tfs.publishBuffers()    # курсоры двигаются и без новых кусков
+            state = tfs.Status().state
+            if self.config.exitOnFinish and tfs is self.TorrentFS and (state == state.finished or state == state.seeding):
+                self.forceShutdown = True
+    def watchdog(self):
+        if os.getppid() == 1:
+            self.forceShutdown = True
+    def saveResumeDataJob(self):
+        self.saveResumeData(True)
     def loop(self):
         def sigterm_handler(_signo, _stack_frame):
             self.forceShutdown = True
         signal.signal(signal.SIGTERM, sigterm_handler)
-        self.statsTicker = Ticker(30)
-        self.saveResumeDataTicker = Ticker(5)
-        time_start = time.time()
-        while True:
-            if self.forceShutdown:
-                return
-            if time.time() - time_start > 0.5:
+        self.scheduler = Scheduler()
+        self.scheduler.every(self.config.housekeepingInterval, self.housekeeping)
+        self.scheduler.every(self.config.statsInterval, self.stats)
+        self.scheduler.every(self.config.resumeInterval, self.saveResumeDataJob)
+        self.scheduler.every(self.config.watchdogInterval, self.watchdog)
+        self.scheduler.every(EVENTS_KEEPALIVE, self.events.keepAlive)
+        if hasattr(self.session, 'post_session_stats'):
+            self.scheduler.every(SESSION_STATS_INTERVAL, self.session.post_session_stats)
+        while not self.forceShutdown:
+            timeout = self.scheduler.timeout()
+            if timeout is None or timeout > MAX_LOOP_WAIT:
+                timeout = MAX_LOOP_WAIT
+            if self.session.wait_for_alert(int(timeout * 1000)) is not None:
                 self.consumeAlerts()
-                self.TorrentFS.LoadFileProgress()
-                state = self.torrentHandle.status().state
-                if self.config.exitOnFinish and (state == state.finished or state == state.seeding):
-                    self.forceShutdown = True
-                if os.getppid() == 1:
-                    self.forceShutdown = True
-                time_start = time.time()
-            if self.statsTicker.true:
-                self.stats()
-            if self.saveResumeDataTicker.true:
-                self.saveResumeData(True)
+            lag = self.scheduler.runPending()
+            if lag is not None:
+                self.metrics.observe('pyrrent2http_loop_lag_seconds', lag)
 
     def processSaveResumeDataAlert(self, alert):
-        logging.info('Saving resume data to: %s', self.config.resumeFile)
-        data = lt.bencode(alert.resume_data)
-        try:
-            with open(self.config.resumeFile, 'wb') as f:
-                f.write(data)
-        except IOError as e:
-            strerror = e.args
-            logging.error(strerror)
+        tfs = self.torrentFSByHandle(alert.handle)
+        if tfs is None or tfs.resumeFile == '':
+            return
+        logging.info('Saving resume data to: %s', tfs.resumeFile)
+        self.stateWriter.save(tfs.resumeFile, lt.bencode(alert.resume_data))
     def saveResumeData(self, async = False):
-        if not self.torrentHandle.status().need_save_resume or self.config.resumeFile == '':
+        pending = 0
+        for tfs in self.Torrents():
+            if tfs.resumeFile != '' and tfs.handle.status().need_save_resume:
+                tfs.handle.save_resume_data(3)
+                pending += 1
+        if pending == 0:
             return False
-        self.torrentHandle.save_resume_data(3)
         if not async:
-            alert = self.waitForAlert(lt.save_resume_data_alert, 5)
-            if alert == None:
-                return False
-            self.processSaveResumeDataAlert(alert)
+            while pending > 0:
+                alert = self.waitForAlert(lt.save_resume_data_alert, 5)
+                if alert == None:
+                    return False
+                self.processSaveResumeDataAlert(alert)
+                pending -= 1
         return True
     def saveSessionState(self):
         if self.config.stateFile == '':
@@ -980,66 +3375,94 @@ class Pyrrent2http(object):
         entry = self.session.save_state()
         data = lt.bencode(entry)
         logging.info('Saving session state to: %s', self.config.stateFile)
-        try:
-            with open(self.config.stateFile, 'wb') as f:
-                f.write(data)
-        except IOError as e:
-            strerror = e.args
-            logging.error(strerror)
-    def removeFiles(self, files):
+        self.stateWriter.save(self.config.stateFile, data)
+    def removeFiles(self, files, quiet = False):
+        '''Удаляет файлы и опустевшие каталоги над ними. Возвращает файлы, которые удалить не удалось'''
+        failed = []
         for file in files:
             try:
                 os.remove(file)
             except Exception as e:
-                strerror = e.args
-                logging.error(strerror)
+                if isinstance(e, OSError) and e.errno == errno.ENOENT:
+                    continue
+                failed.append(file)
+                if not quiet:
+                    strerror = e.args
+                    logging.error(strerror)
             else:
                 path = os.path.dirname(file)
                 savePath = os.path.abspath(self.config.downloadPath)
                 savePath = savePath[-1] == os.path.sep and savePath[:-1] or savePath
                 while path != savePath:
-                    os.remove(path)
+                    try:
+                        os.rmdir(path)
+                    except OSError:
+                        break   # В каталоге остались другие файлы
                     path_ = os.path.dirname(path)
                     path = path_[-1] == os.path.sep and path_[:-1] or path_
-    def filesToRemove(self):
+        return failed
+    def retryRemovals(self):
+        '''Удаляет файлы торрентов, убранных через /remove. libtorrent закрывает их не сразу
+        (в Windows открытый файл не удалить), поэтому неудачное удаление повторяется из housekeeping'''
+        if not self.removals:
+            return
+        removals, self.removals = self.removals, list()
+        for file, attempts in removals:
+            if self.removeFiles([file], attempts > 1) and attempts > 1:
+                self.removals.append((file, attempts - 1))
+    def filesToRemove(self, tfs):
         files = []
-        if self.TorrentFS.HasTorrentInfo():
-            for file in self.TorrentFS.Files():
-                if (not self.config.keepComplete or not file.IsComplete()) and (not self.config.keepIncomplete or file.IsComplete()):
-                    if os.path.exists(file.SavePath()):
-                        files.append(file.SavePath())
-    def removeTorrent(self):
+        if tfs.HasTorrentInfo():
+            for file in tfs.Files():
+                isComplete = tfs.getFileDownloadedBytes(file.index) == file.size
+                if (not self.config.keepComplete or not isComplete) and (not self.config.keepIncomplete or isComplete):
+                    if os.path.exists(file.savePath):
+                        files.append(file.savePath)
+        return files
+    def removeTorrent(self, tfs, wait = True):
         files = []
         flag = 0
-        state = self.torrentHandle.status().state
+        state = tfs.handle.status().state
         #if state != state.checking_files and state != state.queued_for_checking and not self.config.keepFiles:
         if state != state.checking_files and not self.config.keepFiles:
             if not self.config.keepComplete and not self.config.keepIncomplete:
                 flag = int(lt.options_t.delete_files)
             else:
-                files = self.filesToRemove()
+                files = self.filesToRemove(tfs)
         logging.info('Removing the torrent')
-        self.session.remove_torrent(self.torrentHandle, flag)
+        if not wait:
+            # Файлы ещё открыты libtorrent: удалим их по torrent_removed_alert из главного цикла
+            if files:
+                self.pendingRemovals[tfs.infoHash] = files
+            self.session.remove_torrent(tfs.handle, flag)
+            return
+        self.session.remove_torrent(tfs.handle, flag)
         if flag > 0 or len(files) > 0:
             logging.info('Waiting for files to be removed')
             self.waitForAlert(lt.torrent_deleted_alert, 15)
-            self.removeFiles(files)
+        self.removeFiles(files)
     def shutdown(self):
         logging.info('Stopping pyrrent2http...')
-        self.statsTicker.stop()
-        self.saveResumeDataTicker.stop()
+        self.events.keepAlive()     # Отпускаем потоки /events
         self.httpListener.shutdown()
         #self.main_alive.clear()
-        self.TorrentFS.Shutdown()
+        torrents = self.Torrents()
+        for tfs in torrents:
+            tfs.Shutdown()
         if self.session != None:
-            self.session.pause()
-            self.waitForAlert(lt.torrent_paused_alert, 10)
-            if self.torrentHandle is not None:
-                self.saveResumeData(False)
-                self.saveSessionState()
-                self.removeTorrent()
+            if len(torrents) > 0:
+                self.session.pause()
+                self.waitForAlert(lt.torrent_paused_alert, 10)
+            self.saveResumeData(False)
+            self.saveSessionState()
+            for tfs in torrents:
+                self.removeTorrent(tfs)
             logging.info('Aborting the session')
             del self.session
+        if self.stateWriter is not None:
+            self.stateWriter.close(10)
+        if self.config.memoryStorage:
+            shutil.rmtree(self.config.downloadPath, ignore_errors = True)
         logging.info('Bye bye')
         sys.exit(0)
 
@@ -1047,6 +3470,7 @@ if __name__ == '__main__':
     try:
         pyrrent2http = Pyrrent2http()
         pyrrent2http.parseFlags()
+        pyrrent2http.startFetch()
     
         pyrrent2http.startSession()
         pyrrent2http.startServices()